@@ -6,31 +6,45 @@
 # License: MIT
 ##
 
-import torch, time, json, math, gc, os
+import torch, time, json, math, os
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
-from .utils import TransformDataset, list_files, \
+from .utils import TransformDataset, \
     get_default_device, batch_to, tensor_size, \
     load_json, summary, fit, get_acc_class, get_acc_binary, \
-    get_iou_score, get_f1_score
+    get_autocast, create_grad_scaler, \
+    get_memory_policy, get_iou_stats, get_iou_from_stats, \
+    get_f1_stats, get_f1_from_stats, create_loader, RandomSubsetSampler, \
+    DevicePrefetcher, find_batch_size, get_compiled_module, remove_state_dict_prefix, \
+    is_main_process, state_to_cpu, save_file, CheckpointWriter, \
+    save_checkpoint, load_checkpoint, is_checkpoint
 
 
 class Model:
     
     def __init__(self, module=None):
+        module, compiled_module = get_compiled_module(module)
         self.device = 'cpu'
         self.transform_x = None
         self.transform_y = None
         self.module = module
+        self.compiled_module = compiled_module
+        self.compile_params = None
         self.optimizer = None
         self.scheduler = None
         self.loss = None
         self.loss_reduction = "mean"
+        self.precision = "fp32"
+        self.scaler = None
+        self.scaler_state = None
         self.best_metrics = ["val_acc", "epoch"]
         self.name = module.__class__.__name__
         self.prefix_name = ""
         self.epoch = 1
         self.history = {}
+        self.history_file_epoch = None
+        self.checkpoint_format = "data"
+        self.train_state_path = None
         self.min_lr = 1e-5
         self.model_path = ""
         self.repository_path = ""
@@ -38,7 +52,18 @@ class Model:
     
     
     def set_module(self, module):
-        self.module = module
+        self.module, self.compiled_module = get_compiled_module(module)
+        return self
+    
+    def set_compile(self, backend="inductor", mode=None, **kwargs):
+        
+        """
+        Compile module forward by torch.compile. Compiled module is created
+        once, so compiled graphs are reused by fit and predict
+        """
+        
+        self.compile_params = {"backend": backend, "mode": mode, **kwargs}
+        self.compiled_module = None
         return self
     
     def set_optimizer(self, optimizer):
@@ -54,6 +79,10 @@ class Model:
         self.scheduler = scheduler
         return self
     
+    def set_precision(self, precision):
+        self.precision = precision
+        return self
+    
     def set_name(self, name):
         self.name = name
         self.set_repository_path(self.repository_path)
@@ -68,6 +97,24 @@ class Model:
         self.model_path = model_path
         return self
     
+    def set_checkpoint_format(self, checkpoint_format):
+        
+        """
+        Set format of train status files. "data" is one torch file,
+        "ckpt" is folder with file for each state dict and manifest.
+        """
+        
+        self.checkpoint_format = checkpoint_format
+        return self
+    
+    def get_checkpoint_ext(self):
+        return ".ckpt" if self.checkpoint_format == "ckpt" else ".data"
+    
+    def get_load_exts(self):
+        if self.checkpoint_format == "ckpt":
+            return [".ckpt", ".data", ".pth"]
+        return [".data", ".ckpt", ".pth"]
+    
     def set_best_metrics(self, best_metrics):
         self.best_metrics = best_metrics
         return self
@@ -94,9 +141,29 @@ class Model:
             batch_len = len(batch["x"])
         return batch_len
     
+    def get_forward_module(self):
+        
+        """
+        Returns compiled module if it exists, otherwise module
+        """
+        
+        if self.compiled_module is None and self.compile_params is not None:
+            self.compiled_module = torch.compile(self.module, **self.compile_params)
+        
+        if self.compiled_module is not None:
+            return self.compiled_module
+        
+        return self.module
+    
     def to(self, device):
         self.module = self.module.to(device)
         self.device = device
+        
+        # Grad scaler is bound to device type
+        if self.scaler is not None:
+            self.scaler_state = self.scaler.state_dict()
+            self.scaler = None
+        
         return self
     
     def to_cuda(self):
@@ -115,6 +182,25 @@ class Model:
         self.module.eval()
         return self
     
+    def get_scaler(self, precision=None):
+        
+        """
+        Returns grad scaler for precision or None if it is not needed
+        """
+        
+        if precision is None:
+            precision = self.precision
+        
+        if self.scaler is None:
+            self.scaler = create_grad_scaler(self.device, precision)
+            
+            # Restore saved state
+            if self.scaler is not None and self.scaler_state:
+                self.scaler.load_state_dict(self.scaler_state)
+                self.scaler_state = None
+        
+        return self.scaler
+    
     
     def load_state_dict(self, save_metrics, strict=False):
         
@@ -127,18 +213,10 @@ class Model:
             
             # Load module
             if "module" in save_metrics:
-                state_dict = save_metrics["module"]
+                state_dict = remove_state_dict_prefix(save_metrics["module"])
                 self.module.load_state_dict(state_dict, strict=strict)
             
-            # Load optimizer
-            if "optimizer" in save_metrics:
-                state_dict = save_metrics["optimizer"]
-                self.optimizer.load_state_dict(state_dict)
-            
-            # Load scheduler
-            if "scheduler" in save_metrics:
-                state_dict = save_metrics["scheduler"]
-                self.scheduler.load_state_dict(state_dict)
+            self.load_train_state_dict(save_metrics)
             
             # Load loss
             #if "loss" in save_metrics:
@@ -146,93 +224,156 @@ class Model:
             #    self.loss.load_state_dict(state_dict)
         
         else:
-            self.module.load_state_dict(save_metrics, strict=strict)
+            state_dict = remove_state_dict_prefix(save_metrics)
+            self.module.load_state_dict(state_dict, strict=strict)
         
         return self
     
     
-    def load_model(self, file_path, full_path=True, epoch=None):
+    def load_train_state_dict(self, save_metrics):
         
         """
-        Load model from file
+        Load optimizer, scheduler and grad scaler state
+        """
+        
+        # Load optimizer
+        if "optimizer" in save_metrics:
+            state_dict = save_metrics["optimizer"]
+            self.optimizer.load_state_dict(state_dict)
+        
+        # Load scheduler
+        if "scheduler" in save_metrics:
+            state_dict = save_metrics["scheduler"]
+            self.scheduler.load_state_dict(state_dict)
+        
+        # Load grad scaler
+        if "scaler" in save_metrics:
+            state_dict = save_metrics["scaler"]
+            if self.scaler is not None:
+                self.scaler.load_state_dict(state_dict)
+            else:
+                self.scaler_state = state_dict
+        
+        return self
+    
+    
+    def load_train_state(self):
+        
+        """
+        Load optimizer, scheduler and grad scaler state of loaded checkpoint.
+        It is called by fit, so state is not read, if model only predicts.
+        """
+        
+        if self.train_state_path is None:
+            return self
+        
+        file_path = self.train_state_path
+        self.train_state_path = None
+        
+        save_metrics = load_checkpoint(file_path,
+            ["optimizer", "scheduler", "scaler"], mmap=False)
+        self.load_train_state_dict(save_metrics)
+        
+        return self
+    
+    
+    def load_model(self, file_path, full_path=True, epoch=None, weights_only=False):
+        
+        """
+        Load model from file. Checkpoint folder is loaded with mmap, optimizer
+        state is loaded later by fit. If weights_only is True, only module
+        weights are loaded.
         """
         
         if not os.path.exists(file_path) and not full_path:
             file_path = os.path.join(self.model_path, file_path)
         
-        save_metrics = torch.load(file_path)
+        self.train_state_path = None
+        
+        if is_checkpoint(file_path):
+            save_metrics = load_checkpoint(file_path, ["module"])
+            if not weights_only:
+                self.train_state_path = file_path
+        
+        else:
+            try:
+                save_metrics = torch.load(file_path, mmap=True)
+            except RuntimeError:
+                # File of old torch format
+                save_metrics = torch.load(file_path)
+            
+            # Copy train state, so it does not use mapped file,
+            # which may be replaced or removed by next save
+            if not weights_only and "epoch" in save_metrics:
+                for key in ["optimizer", "scheduler", "scaler"]:
+                    if key in save_metrics:
+                        save_metrics[key] = state_to_cpu(save_metrics[key])
+        
+        if weights_only:
+            if "epoch" in save_metrics:
+                save_metrics = save_metrics["module"]
+            self.load_state_dict(save_metrics)
+            return self
+        
         self.load_state_dict(save_metrics)
         
         if epoch:
             self.epoch = epoch + 1
         
         return self
-        
     
-    def load_epoch(self, epoch):
+    
+    def load_epoch(self, epoch, weights_only=False):
         
         """
         Load epoch
         """
         
-        file_name = self.get_model_name() + "-" + str(epoch) + ".data"
-        file_path = os.path.join(self.model_path, file_name)
-        
-        if not os.path.exists(file_path):
-            file_name = self.get_model_name() + "-" + str(epoch) + ".pth"
+        for ext in self.get_load_exts():
+            file_name = self.get_model_name() + "-" + str(epoch) + ext
             file_path = os.path.join(self.model_path, file_name)
+            if os.path.exists(file_path) or is_checkpoint(file_path):
+                break
         
-        self.load_model(file_path, full_path=True)
+        self.load_model(file_path, full_path=True, weights_only=weights_only)
         self.epoch = epoch + 1
         
         return self
-        
-        
-    def load_last(self):
+    
+    
+    def load_last(self, weights_only=False):
         
         """
         Load last model
         """
         
-        file_name = self.get_model_name() + ".data"
-        file_path = os.path.join(self.model_path, file_name)
-        
-        if not os.path.exists(file_path):
-            file_name = self.get_model_name() + ".pth"
+        for ext in self.get_load_exts():
+            file_name = self.get_model_name() + ext
             file_path = os.path.join(self.model_path, file_name)
+            if os.path.exists(file_path) or is_checkpoint(file_path):
+                self.load_model(file_path, full_path=True, weights_only=weights_only)
+                return self
         
-        if os.path.exists(file_path):
-            self.load_model(file_path, full_path=True)
-            return self
-        
-        file_name = os.path.join(self.model_path, "history.json")
-        if os.path.exists(file_name):
+        obj = self.load_history_index()
         
-            obj = load_json(file_name)
-            
-            if obj is not None:
-                epoch = obj["epoch"]
-                self.load_epoch(epoch)
+        if obj is not None:
+            epoch = obj["epoch"]
+            self.load_epoch(epoch, weights_only=weights_only)
         
         return self
-        
     
-    def load_best(self):
+    
+    def load_best(self, weights_only=False):
         
         """
         Load best model
         """
         
-        file_path = os.path.join(self.model_path, "history.json")
-        
-        if not os.path.exists(file_path):
-            return self
-        
-        obj = load_json(file_path)
+        obj = self.load_history_index()
         
         if obj is not None:
             best_epoch = obj["best_epoch"]
-            self.load_epoch(best_epoch)
+            self.load_epoch(best_epoch, weights_only=weights_only)
         
         return self
     
@@ -285,20 +426,22 @@ class Model:
         if not os.path.isdir(self.model_path):
             os.makedirs(self.model_path)
         
-        file_name = self.get_model_name() + "-" + str(self.epoch) + ".data"
+        file_name = self.get_model_name() + "-" + str(self.epoch) + self.get_checkpoint_ext()
         file_path = os.path.join(self.model_path, file_name)
         self.save_model(file_path)
         
         return self
     
-        
-    def save_model(self, file_path=None):
+    
+    def get_save_metrics(self):
         
         """
-        Save train status
+        Returns train status
         """
         
-        # Get metrics
+        # Optimizer state of loaded checkpoint is not loaded yet
+        self.load_train_state()
+        
         save_metrics = {}
         save_metrics["name"] = self.get_model_name()
         save_metrics["epoch"] = self.epoch
@@ -311,40 +454,170 @@ class Model:
         if self.scheduler is not None:
             save_metrics["scheduler"] = self.scheduler.state_dict()
         
+        if self.scaler is not None and self.scaler.is_enabled():
+            save_metrics["scaler"] = self.scaler.state_dict()
+        
         #if self.loss is not None:
         #    save_metrics["loss"] = self.loss.state_dict()
         
+        return save_metrics
+    
+    
+    def save_model(self, file_path=None):
+        
+        """
+        Save train status
+        """
+        
+        save_metrics = self.get_save_metrics()
+        
         # Create folder
         if not os.path.isdir(self.model_path):
             os.makedirs(self.model_path)
         
         # Save model to file
         if file_path is None:
-            model_file_name = self.get_model_name() + ".data"
+            model_file_name = self.get_model_name() + self.get_checkpoint_ext()
             file_path = os.path.join(self.model_path, model_file_name)
         
-        torch.save(save_metrics, file_path)
+        self.save_train_status(save_metrics, file_path)
         
         return self
     
     
-    def save_history(self):
+    def save_train_status(self, save_metrics, file_path):
         
         """
-        Save history to json
+        Save train status to file in checkpoint format
         """
         
-        best_epoch = self.get_the_best_epoch(self.best_metrics)
-        file_name = os.path.join(self.model_path, "history.json")
+        if self.checkpoint_format == "ckpt":
+            save_checkpoint(save_metrics, file_path)
+        else:
+            save_file(save_metrics, file_path)
+        
+        return self
+    
+    
+    def save_history(self, history=None, epoch=None):
+        
+        """
+        Save history to history.jsonl and history.index.json.
+        New epochs are appended to history.jsonl, one line per epoch.
+        The first save rewrites the file, so epochs of previous run after
+        resumed epoch are removed. Index contains last and the best epoch.
+        History and epoch may be copies, if history is saved in background.
+        Only main process saves history.
+        """
+        
+        if not is_main_process():
+            return self
+        
+        if history is None:
+            history = self.history
+        
+        if epoch is None:
+            epoch = self.epoch
+        
+        if not os.path.isdir(self.model_path):
+            os.makedirs(self.model_path)
+        
+        file_name = os.path.join(self.model_path, "history.jsonl")
+        epochs = sorted(history.keys())
+        
+        if self.history_file_epoch is None:
+            mode = "w"
+        else:
+            mode = "a"
+            epochs = [ epoch for epoch in epochs if epoch > self.history_file_epoch ]
+        
+        lines = [
+            json.dumps({"epoch": index, "status": self.get_epoch_summary(history[index])}) + "\n"
+                for index in epochs
+        ]
+        
+        if mode == "w":
+            tmp_file = file_name + ".tmp"
+            with open(tmp_file, "w") as file:
+                file.write("".join(lines))
+            os.replace(tmp_file, file_name)
+        elif len(lines) > 0:
+            with open(file_name, "a") as file:
+                file.write("".join(lines))
+        
+        if len(history) > 0:
+            self.history_file_epoch = max(history.keys())
+        else:
+            self.history_file_epoch = 0
+        
+        # Save index
+        index_file = os.path.join(self.model_path, "history.index.json")
         obj = {
-            "epoch": self.epoch,
-            "best_epoch": best_epoch,
-            "history": self.history.copy(),
+            "epoch": epoch,
+            "best_epoch": self.get_the_best_epoch(self.best_metrics, history),
+            "count": len(history),
+            "last_epoch": self.history_file_epoch,
         }
-        json_str = json.dumps(obj, indent=2)
-        file = open(file_name, "w")
-        file.write(json_str)
-        file.close()
+        tmp_file = index_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(obj, file)
+        os.replace(tmp_file, index_file)
+        
+        return self
+    
+    
+    def load_history_index(self):
+        
+        """
+        Returns history index with last and the best epoch.
+        Reads history.json, if model is saved in old format.
+        """
+        
+        file_name = os.path.join(self.model_path, "history.index.json")
+        if os.path.exists(file_name):
+            return load_json(file_name)
+        
+        file_name = os.path.join(self.model_path, "history.json")
+        if os.path.exists(file_name):
+            return load_json(file_name)
+        
+        return None
+    
+    
+    def load_history(self):
+        
+        """
+        Load history from history.jsonl. Epochs after last epoch
+        of index are skipped.
+        """
+        
+        file_name = os.path.join(self.model_path, "history.jsonl")
+        index = self.load_history_index()
+        
+        if not os.path.exists(file_name):
+            if index is not None and "history" in index:
+                self.history = {
+                    int(epoch): self.get_epoch_summary(status)
+                        for epoch, status in index["history"].items()
+                }
+            return self
+        
+        last_epoch = index.get("last_epoch") if index is not None else None
+        history = {}
+        
+        with open(file_name, "r") as file:
+            for line in file:
+                
+                # Skip unfinished line
+                if not line.endswith("\n"):
+                    break
+                
+                item = json.loads(line)
+                epoch = item["epoch"]
+                if last_epoch is None or epoch <= last_epoch:
+                    history[epoch] = item["status"]
+        
+        self.history = history
         
         return self
     
@@ -374,19 +647,22 @@ class Model:
     
     
     def __call__(self, x):
-        return self.module(x)
+        return self.get_forward_module()(x)
     
     
-    def predict(self, x):
+    def predict(self, x, precision=None):
         
         """
         Predict
         """
         
+        if precision is None:
+            precision = self.precision
+        
         batch = {"x":x}
         batch_transform = getattr(self.module, "batch_transform", None)
         
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(self.device, precision):
             
             self.module.eval()
             
@@ -402,12 +678,15 @@ class Model:
             
             else:
                 x = batch_to(x, self.device)
-                y = self.module(x)
+                y = self.get_forward_module()(x)
         
         return y
     
     
-    def predict_dataset(self, dataset, predict, batch_size=64, obj=None, collate_fn=None):
+    def predict_dataset(self, dataset, predict, batch_size=64, obj=None,
+        collate_fn=None, precision=None, memory_policy=None, loader_params=None,
+        prefetch=False
+    ):
         
         """
         Predict dataset
@@ -416,13 +695,20 @@ class Model:
         loader = None
         device = self.device
         
+        if precision is None:
+            precision = self.precision
+        
+        memory_policy = get_memory_policy(memory_policy)
+        
+        if loader_params is None:
+            loader_params = {}
+        
         if isinstance(dataset, Dataset):
-            loader = DataLoader(
+            loader = create_loader(
                 dataset,
                 batch_size=batch_size,
                 collate_fn=collate_fn,
-                drop_last=False,
-                shuffle=False
+                **loader_params
             )
         
         if isinstance(dataset, DataLoader):
@@ -430,8 +716,33 @@ class Model:
         
         batch_transform = getattr(self.module, "batch_transform", None)
         get_batch_size = getattr(self.module, "get_batch_size", None)
+        forward_module = self.get_forward_module()
         
-        with torch.no_grad():
+        def step_predict(batch):
+            
+            if hasattr(self.module, "step_forward"):
+                _, y_predict = self.module.step_forward(batch, {
+                    "model": self
+                })
+            
+            else:
+                x_batch = batch_to(batch["x"], device)
+                y_predict = forward_module(x_batch)
+                del x_batch
+            
+            return y_predict
+        
+        def prepare_batch(batch):
+            if batch_transform:
+                batch = batch_transform(batch, device)
+            return batch
+        
+        if prefetch:
+            loader = DevicePrefetcher(loader, device, prepare_batch)
+        else:
+            loader = map(prepare_batch, loader)
+        
+        with torch.no_grad(), get_autocast(device, precision):
         
             self.module.eval()
             
@@ -442,19 +753,7 @@ class Model:
             
             for batch in loader:
                 
-                if batch_transform:
-                    batch = batch_transform(batch, self.device)
-                
-                if hasattr(self.module, "step_forward"):
-                    _, y_predict = self.module.step_forward(batch, {
-                        "model": self
-                    })
-                
-                else:
-                    x_batch = batch_to(batch["x"], device)
-                    y_predict = self.module(x_batch)
-                    del x_batch
-                
+                y_predict = memory_policy.run(step_predict, batch)
                 predict(batch, y_predict, obj)
                 
                 # Batch size
@@ -475,17 +774,13 @@ class Model:
                     )
                 
                 del y_predict, batch
-                
-                # Clear cache
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                
-                gc.collect()
+                memory_policy.on_iter()
             
+            memory_policy.on_epoch()
             print ("\nOk")
     
     
-    def get_metrics(self, metric_name, convert=False):
+    def get_metrics(self, metric_name, convert=False, history=None):
         
         """
         Returns metrics by name
@@ -502,11 +797,14 @@ class Model:
                 return -value
             return value
         
+        if history is None:
+            history = self.history
+        
         res = []
-        epochs = list(self.history.keys())
+        epochs = list(history.keys())
         for index in epochs:
             
-            epoch = self.history[index]
+            epoch = history[index]
             res2 = [ index ]
             
             if isinstance(metric_name, list):
@@ -547,18 +845,18 @@ class Model:
         return res
     
     
-    def get_the_best_epoch(self, best_metrics=None):
+    def get_the_best_epoch(self, best_metrics=None, history=None):
         
         """
         Returns the best epoch
         """
         
-        epoch_indexes = self.get_the_best_epochs_indexes(1, best_metrics)
+        epoch_indexes = self.get_the_best_epochs_indexes(1, best_metrics, history)
         best_epoch = epoch_indexes[0] if len(epoch_indexes) > 0 else 0
         return best_epoch
     
     
-    def get_the_best_epochs_indexes(self, epoch_count=5, best_metrics=None):
+    def get_the_best_epochs_indexes(self, epoch_count=5, best_metrics=None, history=None):
         
         """
         Returns best epoch indexes
@@ -567,7 +865,7 @@ class Model:
         if best_metrics is None:
             best_metrics = self.best_metrics
         
-        metrics = self.get_metrics(best_metrics, convert=True)
+        metrics = self.get_metrics(best_metrics, convert=True, history=history)
         metrics.sort(key=lambda x: x[1:])
         
         res = []
@@ -609,12 +907,15 @@ class Model:
         return self.get_the_best_epochs_indexes(epoch_count, best_metrics)
     
     
-    def save_the_best_models(self, max_best_models=10):
+    def save_the_best_models(self, max_best_models=10, epoch=None, history=None):
         
         """
-        Save the best models
+        Save the best models. Files of other epochs are removed.
         """
         
+        if epoch is None:
+            epoch = self.epoch
+        
         def detect_type(file_name):
             
             import re
@@ -631,15 +932,21 @@ class Model:
             if result:
                 return "model", int(result.group("id"))
             
+            result = re.match(r'^'+model_name+'-(?P<id>[0-9]+)\.ckpt(\.old)?$', file_name)
+            if result:
+                return "model", int(result.group("id"))
+            
             return file_type, epoch_index
         
         
-        if self.epoch > 0 and max_best_models > 0 and os.path.isdir(self.model_path):
+        if epoch > 0 and max_best_models > 0 and os.path.isdir(self.model_path):
+            
+            epoch_indexes = self.get_the_best_epochs_indexes(max_best_models, history=history)
+            epoch_indexes.append( epoch )
             
-            epoch_indexes = self.get_the_best_epochs_indexes(max_best_models)
-            epoch_indexes.append( self.epoch )
+            import shutil
             
-            files = list_files( self.model_path )
+            files = os.listdir( self.model_path )
             
             for file_name in files:
                 
@@ -649,10 +956,13 @@ class Model:
                     not (epoch_index in epoch_indexes):
                     
                     file_path = os.path.join( self.model_path, file_name )
-                    os.unlink(file_path)
+                    if os.path.isdir(file_path):
+                        shutil.rmtree(file_path)
+                    else:
+                        os.unlink(file_path)
     
     
-    def summary(self, x, batch_size=2, collate_fn=None, ignore=None):
+    def summary(self, x, batch_size=2, collate_fn=None, ignore=None, loader_params=None):
         
         """
         Show model summary
@@ -663,7 +973,28 @@ class Model:
             collate_fn=collate_fn,
             model_name=self.get_model_name(),
             batch_size=batch_size,
-            ignore=ignore
+            ignore=ignore,
+            loader_params=loader_params
+        )
+    
+    
+    def find_batch_size(self, dataset, mode="train", collate_fn=None,
+        min_batch_size=2, max_batch_size=4096, repeat=3, precision=None,
+        loader_params=None
+    ):
+        
+        """
+        Returns the largest batch size, which fits in device memory
+        """
+        
+        return find_batch_size(self, dataset,
+            mode=mode,
+            collate_fn=collate_fn,
+            min_batch_size=min_batch_size,
+            max_batch_size=max_batch_size,
+            repeat=repeat,
+            precision=precision,
+            loader_params=loader_params
         )
     
         
@@ -735,16 +1066,12 @@ class Model:
             "time_start": 0,
             "time_end": 0,
             "train_acc": 0,
-            "train_acc_items": [],
             "train_count": 0,
             "train_loss": 0,
-            "train_loss_items": [],
             "train_batch_iter": 0,
             "val_acc": 0,
-            "val_acc_items": [],
             "val_count": 0,
             "val_loss": 0,
-            "val_loss_items": [],
             "val_batch_iter": 0,
             "iter_value": 0,
             "total_count": 0,
@@ -755,25 +1082,66 @@ class Model:
         return status
     
     
+    def get_epoch_summary(self, status):
+        
+        """
+        Returns scalar values of epoch status. Per batch items are skipped.
+        """
+        
+        def is_scalar(value):
+            return value is None or isinstance(value, (int, float, str, bool))
+        
+        res = {}
+        for key, value in status.items():
+            
+            if key.endswith("_items"):
+                continue
+            
+            if isinstance(value, torch.Tensor) and value.numel() == 1:
+                value = value.item()
+            
+            if is_scalar(value):
+                res[key] = value
+            
+            elif isinstance(value, (list, tuple)) and all(map(is_scalar, value)):
+                res[key] = list(value)
+        
+        return res
+    
+    
     def add_epoch(self, params):
         status = params["status"]
         epoch = status["epoch"]
-        self.history[epoch] = status.copy()
+        self.history[epoch] = self.get_epoch_summary(status)
     
     
-    def on_train_iter(self, params):
+    def update_loss(self, params, kind):
+        
+        """
+        Update loss in status from metric sums
+        """
         
         status = params["status"]
-        train_count = status["train_count"]
-        train_loss_items = status["train_loss_items"]
+        values = params["metrics"].get_values()
+        loss_sum = values[kind + "_loss"] if kind + "_loss" in values else 0
+        batch_iter = status[kind + "_batch_iter"]
+        count = status[kind + "_count"]
         
         if self.loss_reduction == "mean":
-            if len(train_loss_items) > 0:
-                status["train_loss"] = sum(train_loss_items) / len(train_loss_items)
+            if batch_iter > 0:
+                status[kind + "_loss"] = loss_sum / batch_iter
         
         elif self.loss_reduction == "sum":
-            if len(train_loss_items) > 0 and train_count > 0:
-                status["train_loss"] = sum(train_loss_items) / train_count
+            if batch_iter > 0 and count > 0:
+                status[kind + "_loss"] = loss_sum / count
+    
+    
+    def on_train_iter(self, params):
+        
+        status = params["status"]
+        
+        if params["iter"].get("sync", True):
+            self.update_loss(params, "train")
         
         if status["total_count"] > 0:
             status["iter_value"] = (status["pos"] / status["total_count"]) * 100
@@ -782,16 +1150,9 @@ class Model:
     def on_val_iter(self, params):
         
         status = params["status"]
-        val_count = status["val_count"]
-        val_loss_items = status["val_loss_items"]
         
-        if self.loss_reduction == "mean":
-            if len(val_loss_items) > 0:
-                status["val_loss"] = sum(val_loss_items) / len(val_loss_items)
-        
-        elif self.loss_reduction == "sum":
-            if len(val_loss_items) > 0 and val_count > 0:
-                status["val_loss"] = sum(val_loss_items) / val_count
+        if params["iter"].get("sync", True):
+            self.update_loss(params, "val")
         
         if status["total_count"] > 0:
             status["iter_value"] = (status["pos"] / status["total_count"]) * 100
@@ -916,9 +1277,10 @@ class Model:
         if not os.path.exists(dest_path):
             os.makedirs(dest_path)
         
-        src_file_path = os.path.join(self.model_path, "history.json")
-        dest_file_path = os.path.join(dest_path, "history.json")
-        shutil.copy(src_file_path, dest_file_path)
+        for file_name in ["history.jsonl", "history.index.json"]:
+            src_file_path = os.path.join(self.model_path, file_name)
+            dest_file_path = os.path.join(dest_path, file_name)
+            shutil.copy(src_file_path, dest_file_path)
     
     
     def download_history_from_google_drive(self, repository_path):
@@ -933,80 +1295,98 @@ class Model:
             os.makedirs(self.model_path)
         
         src_path = os.path.join(repository_path, self.get_model_name())
-        src_file_path = os.path.join(src_path, "history.json")
-        dest_file_path = os.path.join(self.model_path, "history.json")
-        shutil.copy(src_file_path, dest_file_path)
+        for file_name in ["history.jsonl", "history.index.json"]:
+            src_file_path = os.path.join(src_path, file_name)
+            dest_file_path = os.path.join(self.model_path, file_name)
+            shutil.copy(src_file_path, dest_file_path)
 
 
 class AccuracyCallback():
     
+    """
+    Accuracy callback. Accuracy values are summed on device and
+    read back every sync_steps batches. If reduction is a function,
+    acc returns dict of sums and reduction calculates metric from them.
+    """
+    
     def __init__(self, acc=None, binary=False, reduction="sum", treshold=0.5):
         self.acc_fn = acc
         self.reduction = reduction
         if self.acc_fn is None:
             if binary:
-                self.acc_fn = get_acc_binary(treshold)
+                self.acc_fn = get_acc_binary(treshold, tensor=True)
             else:
-                self.acc_fn = get_acc_class()
+                self.acc_fn = get_acc_class(tensor=True)
     
     def acc(self, y_pred, y_batch):
         return self.acc_fn(y_pred, y_batch)
     
+    def update_acc(self, params, kind):
+        
+        """
+        Update accuracy in status from metric sums
+        """
+        
+        status = params["status"]
+        values = params["metrics"].get_values()
+        name = kind + "_acc"
+        batch_iter = status[kind + "_batch_iter"]
+        count = status[kind + "_count"]
+        
+        if batch_iter == 0:
+            return
+        
+        if callable(self.reduction):
+            prefix = name + "_"
+            stats = {}
+            for key in values:
+                if key.startswith(prefix):
+                    stats[key[len(prefix):]] = values[key]
+            status[name] = self.reduction(stats)
+        
+        elif self.reduction == "mean":
+            status[name] = values.get(name, 0) / batch_iter
+        
+        elif self.reduction == "sum":
+            if count > 0:
+                status[name] = values.get(name, 0) / count
+        
+        status[name + "_percent"] = status[name] * 100
+    
     def on_start_epoch(self, params):
         status = params["status"]
         status["train_acc"] = 0
         status["train_acc_percent"] = 0
-        status["train_acc_items"] = []
         status["val_acc"] = 0
         status["val_acc_percent"] = 0
-        status["val_acc_items"] = []
     
     def on_train_iter(self, params):
         
-        status = params["status"]
-        train_acc_items = status["train_acc_items"]
-        train_count = status["train_count"]
         y_batch = params["iter"]["y_batch"]
         y_pred = params["iter"]["y_pred"]
         
         # Calc accuracy
-        acc_value = self.acc(y_pred, y_batch)
-        train_acc_items.append(acc_value)
-        
-        if self.reduction == "mean":
-            if len(train_acc_items) > 0:
-                status["train_acc"] = sum(train_acc_items) / len(train_acc_items)
-                status["train_acc_percent"] = status["train_acc"] * 100
+        params["metrics"].add("train_acc", self.acc(y_pred, y_batch))
         
-        elif self.reduction == "sum":
-            if len(train_acc_items) > 0 and train_count > 0:
-                status["train_acc"] = sum(train_acc_items) / train_count
-                status["train_acc_percent"] = status["train_acc"] * 100
+        if params["iter"].get("sync", True):
+            self.update_acc(params, "train")
     
     def on_val_iter(self, params):
         
-        status = params["status"]
-        val_acc_items = status["val_acc_items"]
-        val_count = status["val_count"]
         y_batch = params["iter"]["y_batch"]
         y_pred = params["iter"]["y_pred"]
         
         # Calc accuracy
-        acc_value = self.acc(y_pred, y_batch)
-        val_acc_items.append(acc_value)
+        params["metrics"].add("val_acc", self.acc(y_pred, y_batch))
         
-        if self.reduction == "mean":
-            if len(val_acc_items) > 0:
-                status["val_acc"] = sum(val_acc_items) / len(val_acc_items)
-                status["val_acc_percent"] = status["val_acc"] * 100
-        
-        elif self.reduction == "sum":
-            if len(val_acc_items) > 0 and val_count > 0:
-                status["val_acc"] = sum(val_acc_items) / val_count
-                status["val_acc_percent"] = status["val_acc"] * 100
-
+        if params["iter"].get("sync", True):
+            self.update_acc(params, "val")
+    
     def on_end_epoch(self, params):
         
+        self.update_acc(params, "train")
+        self.update_acc(params, "val")
+        
         status = params["status"]
         if not(status["train_acc"] is None) and not(status["val_acc"] is None):
             status["rel"] = (status["train_acc"] / status["val_acc"]) if status["val_acc"] > 0 else 0
@@ -1014,12 +1394,12 @@ class AccuracyCallback():
 
 class IoU(AccuracyCallback):
     def __init__(self, logits=True, treshold=0.5):
-        super().__init__(acc=get_iou_score(logits), reduction="mean")
+        super().__init__(acc=get_iou_stats(logits, treshold), reduction=get_iou_from_stats)
 
 
 class F1Score(AccuracyCallback):
     def __init__(self, logits=True, treshold=0.5):
-        super().__init__(acc=get_f1_score(logits, treshold), reduction="mean")
+        super().__init__(acc=get_f1_stats(logits, treshold), reduction=get_f1_from_stats)
 
     
 class ReAccuracyCallback():
@@ -1058,36 +1438,103 @@ class ReAccuracyCallback():
 
 class SaveCallback():
     
-    def __init__(self, count=20, save_weights=True, save_train=False, save_last=False):
+    """
+    Save model at the end of epoch. If async_save is True, state is copied
+    to CPU and files are written in background thread, so training does not
+    wait for disk. Only one save is run at time. Files of old epochs
+    are removed in the same thread.
+    """
+    
+    def __init__(self, count=20, save_weights=True, save_train=False, save_last=False,
+        async_save=True
+    ):
         self.count = count
         self.save_weights = save_weights
         self.save_train = save_train
         self.save_last = save_last
+        self.async_save = async_save
+        self.writer = CheckpointWriter()
     
-    def on_save(self, params):
+    def save(self, model, epoch, history, weights, train):
         
-        model = params["model"]
+        """
+        Save files of epoch
+        """
+        
+        if not os.path.isdir(model.model_path):
+            os.makedirs(model.model_path)
         
-        is_save = False
+        file_name = model.get_model_name()
+        
+        ext = model.get_checkpoint_ext()
         
         if self.save_train:
-            model.save_train_epoch()
-            is_save = True
+            file_path = os.path.join(model.model_path, file_name + "-" + str(epoch) + ext)
+            model.save_train_status(train, file_path)
         
         if self.save_weights:
-            model.save_weights_epoch()
-            is_save = True
+            file_path = os.path.join(model.model_path, file_name + "-" + str(epoch) + ".pth")
+            save_file(weights, file_path)
+        
+        if self.save_last:
+            file_path = os.path.join(model.model_path, file_name + ext)
+            model.save_train_status(train, file_path)
         
         if self.count >= 0:
-            model.save_the_best_models(self.count)
-            is_save = True
+            model.save_the_best_models(self.count, epoch, history)
         
-        if self.save_last:
-            model.save_model()
-            is_save = True
+        if self.save_train or self.save_weights or self.save_last or self.count >= 0:
+            model.save_history(history, epoch)
+    
+    def on_save(self, params):
+        
+        # Only main process saves model
+        if not is_main_process():
+            return
+        
+        model = params["model"]
+        
+        # Wait for previous save, so only one copy of state is in memory
+        self.writer.wait()
+        
+        train = None
+        weights = None
+        
+        if self.save_train or self.save_last:
+            train = model.get_save_metrics()
+            weights = train["module"]
+        
+        elif self.save_weights:
+            weights = model.module.state_dict()
+        
+        history = model.history.copy()
+        
+        if not self.async_save:
+            self.save(model, model.epoch, history, weights, train)
+            return
+        
+        if train is not None:
+            train = state_to_cpu(train)
+            weights = train["module"]
         
-        if is_save:
-            model.save_history()
+        elif weights is not None:
+            weights = state_to_cpu(weights)
+        
+        self.writer.put(self.save, model, model.epoch, history, weights, train)
+    
+    def flush(self):
+        
+        """
+        Wait for background save
+        """
+        
+        self.writer.wait()
+    
+    def on_end(self, params):
+        self.flush()
+    
+    def on_stop(self, params):
+        self.flush()
 
 
 class ProgressCallback():
@@ -1155,7 +1602,7 @@ class ProgressCallback():
         
         status = params["status"]
         
-        if self.progress_iter:
+        if self.progress_iter and params["iter"].get("sync", True) and is_main_process():
             print ("\r" + self.get_progress_string("train", status), end="")
     
     
@@ -1163,7 +1610,7 @@ class ProgressCallback():
         
         status = params["status"]
         
-        if self.progress_iter:
+        if self.progress_iter and params["iter"].get("sync", True) and is_main_process():
             print ("\r" + self.get_progress_string("val", status), end="")
     
     
@@ -1171,6 +1618,9 @@ class ProgressCallback():
         
         status = params["status"]
         
+        if not is_main_process():
+            return
+        
         if self.one_line:
             print( "\r" + self.get_epoch_string(status), end="" )
         else:
@@ -1178,6 +1628,10 @@ class ProgressCallback():
     
     
     def on_end(self, params):
+        
+        if not is_main_process():
+            return
+        
         if self.one_line:
             print ("")
         
@@ -1186,26 +1640,43 @@ class ProgressCallback():
 
 class ReloadDatasetCallback():
     
-    def on_start_epoch(self, params):
+    """
+    Creates loaders for train and val dataset. Loaders are created again
+    only if dataset is changed, so loader workers are not respawned every epoch.
+    """
+    
+    def __init__(self):
+        self.loaders = {}
+    
+    def get_loader(self, params, name, shuffle):
         
-        # Train loader
-        params["train_loader"] = DataLoader(
-            params["train_dataset"],
+        dataset = params[name + "_dataset"]
+        dataset_len = len(dataset)
+        
+        if name in self.loaders:
+            loader, loader_dataset, loader_len = self.loaders[name]
+            if loader_dataset is dataset and loader_len == dataset_len:
+                return loader
+        
+        loader = create_loader(
+            dataset,
             batch_size=params["batch_size"],
             collate_fn=params["collate_fn"],
-            drop_last=False,
-            shuffle=True
+            shuffle=shuffle,
+            **params["loader_params"]
         )
+        self.loaders[name] = (loader, dataset, dataset_len)
+        
+        return loader
+    
+    def on_start_epoch(self, params):
+        
+        # Train loader
+        params["train_loader"] = self.get_loader(params, "train", True)
         
         # Val loader
-        if "val_dataset" in params:
-            params["val_loader"] = DataLoader(
-                params["val_dataset"],
-                batch_size=params["batch_size"],
-                collate_fn=params["collate_fn"],
-                drop_last=False,
-                shuffle=False
-            )
+        if params["val_dataset"] is not None:
+            params["val_loader"] = self.get_loader(params, "val", False)
 
 
 class RandomDatasetCallback():
@@ -1213,38 +1684,41 @@ class RandomDatasetCallback():
     def __init__(self, train_count, val_count=None):
         self.train_count = train_count
         self.val_count = val_count
+        self.train_loader = None
+        self.val_loader = None
 
     def get_indices(self, total_count, iter_count):
         indices = list(np.random.permutation(total_count))
         return indices[:iter_count]
+    
+    def get_loader(self, params, dataset, count):
+        return create_loader(
+            dataset,
+            batch_size=params["batch_size"],
+            collate_fn=params["collate_fn"],
+            sampler=RandomSubsetSampler(len(dataset), count),
+            **params["loader_params"]
+        )
 
     def on_start_epoch(self, params):
         
-        from torch.utils.data import SubsetRandomSampler
-        
         status = params['status']
-        batch_size = params['batch_size']
-
-        params['train_loader'] = DataLoader(
-            params['train_dataset'],
-            batch_size=batch_size,
-            collate_fn=params["collate_fn"],
-            sampler=SubsetRandomSampler(
-                self.get_indices(len(params['train_dataset']), self.train_count)
+        
+        # Sampler takes new random indices every epoch
+        if self.train_loader is None:
+            self.train_loader = self.get_loader(
+                params, params['train_dataset'], self.train_count
             )
-        )
         
+        params['train_loader'] = self.train_loader
         status["total_count"] = self.train_count
         
         if self.val_count is not None:
-            params['val_loader'] = DataLoader(
-                params['val_dataset'],
-                batch_size=batch_size,
-                collate_fn=params["collate_fn"],
-                sampler=SubsetRandomSampler(
-                    self.get_indices(len(params['val_dataset']), self.val_count)
+            
+            if self.val_loader is None:
+                self.val_loader = self.get_loader(
+                    params, params['val_dataset'], self.val_count
                 )
-            )
             
+            params['val_loader'] = self.val_loader
             status["total_count"] += self.val_count
-
@@ -10,8 +10,11 @@ from .Model import Model, SaveCallback, ProgressCallback, \
         ReloadDatasetCallback, RandomDatasetCallback, \
         AccuracyCallback, ReAccuracyCallback, F1Score, IoU
 from .layers import *
-from .utils import compile, fit
-from .csv import CSVReader
+from .utils import compile, fit, launch
+from .csv import CSVReader, CSVDataset, CSVIterableDataset
+from .text import Vocabulary
+from .store import materialize, MaterializedDataset
+from .sweep import sweep, LogUniform
 
 __version__ = "0.1.15"
 
@@ -23,7 +26,11 @@ __all__ = (
     "ReAccuracyCallback",
     "ReloadDatasetCallback",
     "SaveCallback",
-    "CSVReader",
+    "CSVReader", "CSVDataset", "CSVIterableDataset",
+    "Vocabulary",
+    "materialize", "MaterializedDataset",
+    "sweep", "LogUniform",
     "compile",
     "fit",
+    "launch",
 )
@@ -6,49 +6,839 @@
 # License: MIT
 ##
 
+import csv, io, mmap, os, struct, time, zlib, torch
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+INDEX_MAGIC = b"TAHCSVI1"
+INDEX_HEADER = "<8sqqqqI"
+INDEX_HEADER_SIZE = 64
+INDEX_TAIL_SIZE = 4096
+NA_VALUES = ["", "NA", "N/A", "NaN", "nan", "null", "NULL", "None"]
+
+
+def find_line_ends(data, start=0, end=None, block_size=1 << 26, max_count=None):
+    
+    """
+    Returns positions of new line chars in data, which are not in quotes.
+    Data is scanned by blocks, so memory usage does not depend on file size.
+    Scan stops after block, where max_count positions are found.
+    """
+    
+    if end is None:
+        end = len(data)
+    
+    res = []
+    res_count = 0
+    quotes = 0
+    for block_start in range(start, end, block_size):
+        
+        count = min(block_size, end - block_start)
+        block = np.frombuffer(data, dtype=np.uint8, count=count, offset=block_start)
+        
+        line_ends = np.flatnonzero(block == 10)
+        quote_pos = np.flatnonzero(block == 34)
+        
+        # New line is in quotes if count of quotes before it is odd
+        if len(quote_pos) > 0:
+            quotes_before = np.searchsorted(quote_pos, line_ends) + quotes
+            line_ends = line_ends[quotes_before % 2 == 0]
+            quotes += len(quote_pos)
+        
+        res.append(line_ends.astype(np.int64) + block_start)
+        res_count += len(line_ends)
+        del block
+        
+        if max_count is not None and res_count >= max_count:
+            break
+    
+    if len(res) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    return np.concatenate(res)
+
+
+def parse_lines(text, columns_count):
+    
+    """
+    Parse csv text to list of columns values
+    """
+    
+    if '"' in text:
+        rows = list(csv.reader(io.StringIO(text), skipinitialspace=True))
+    else:
+        if text.endswith("\n"):
+            text = text[:-1]
+        if text == "":
+            return [ [] for i in range(columns_count) ]
+        
+        # Fast path, if all rows have same count of values
+        values = text.replace("\n", ",").split(",")
+        if len(values) == (text.count("\n") + 1) * columns_count:
+            data = np.frombuffer(text.encode("utf-8") + b"\n", dtype=np.uint8)
+            commas = np.cumsum(data == 44)[data == 10]
+            if (np.diff(commas, prepend=0) == columns_count - 1).all():
+                return [ values[i::columns_count] for i in range(columns_count) ]
+        
+        rows = [ line.split(",") for line in text.split("\n") ]
+    
+    # Rows with other count of values
+    if any( len(row) != columns_count for row in rows ):
+        rows = [
+            (row + [""] * (columns_count - len(row)))[:columns_count]
+                for row in rows
+        ]
+    
+    if len(rows) == 0:
+        return [ [] for i in range(columns_count) ]
+    
+    return list(zip(*rows))
+
+
+def parse_chunk(text, columns_count, columns, na_values):
+    
+    """
+    Parse csv text to typed columns. columns is list of
+    (name, position, dtype, fill value). Category column is returned as
+    (items, codes), where codes are local for the chunk.
+    """
+    
+    values = parse_lines(text, columns_count)
+    res = []
+    
+    for name, pos, dtype, fill_value in columns:
+        
+        column = np.char.strip(np.array(values[pos], dtype=str))
+        is_na = np.isin(column, na_values)
+        
+        if dtype == "category":
+            
+            items, inverse = np.unique(column, return_inverse=True)
+            na_items = np.isin(items, na_values)
+            codes = np.full(len(items) + 1, -1, dtype=np.int64)
+            codes[:-1][~na_items] = np.arange((~na_items).sum())
+            column = (items[~na_items].tolist(), codes[inverse.reshape(-1)])
+        
+        elif dtype == "str":
+            column = np.where(is_na, "", column).astype(object)
+        
+        else:
+            dtype = np.dtype(dtype)
+            if np.issubdtype(dtype, np.floating):
+                column = np.where(is_na, "nan", column)
+            else:
+                column = np.where(is_na, str(fill_value), column)
+            
+            try:
+                column = column.astype(dtype)
+            except ValueError as e:
+                raise ValueError("Column " + name + ": " + str(e))
+        
+        res.append(column)
+    
+    return res
+
+
+def read_chunk(file_name, encoding, start, end, *args):
+    
+    """
+    Read and parse chunk of csv file in worker process
+    """
+    
+    with open(file_name, "rb") as file:
+        file.seek(start)
+        text = str(file.read(end - start), encoding)
+    
+    return parse_chunk(text, *args)
+
+
+def parse_line(line):
+    
+    """
+    Parse csv line to list of values
+    """
+    
+    line = line.strip()
+    
+    if '"' in line:
+        values = next(csv.reader([line], skipinitialspace=True))
+    else:
+        values = line.split(",")
+    
+    return [ s.strip() for s in values ]
+
 
 class CSVReader:
     
-    def __init__(self, file_name, encoding):
-        self.file = open(file_name, 'rb')
+    """
+    CSV file reader. File is memory mapped, lines offsets are stored
+    in int64 array. Row is read by index as dict.
+    
+    Offsets are saved to index file next to csv (file_name + ".idx").
+    Index is used if file size and mtime are not changed, and is extended
+    if rows were appended to the file.
+    """
+    
+    def __init__(self, file_name, encoding="utf-8", index=True, index_file=None):
+        self.file_name = file_name
         self.encoding = encoding
-        self.lines = []
+        self.file = None
+        self.data = None
+        self.header = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.index = index
+        self.index_file = index_file if index_file is not None else file_name + ".idx"
+        self.index_loaded = False
+        self.open()
+        self.read_header()
+        self.read_file()
+    
+    def open(self):
+        
+        """
+        Open and memory map file
+        """
+        
+        self.file = open(self.file_name, 'rb')
         self.file.seek(0, 2)
         self.file_size = self.file.tell()
         self.file.seek(0, 0)
-        self.read_header()
-        self.read_file()
         
+        if self.file_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+    
+    def close(self):
+        
+        """
+        Close file
+        """
+        
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        
+        if self.file is not None:
+            self.file.close()
+        
+        self.data = None
+        self.file = None
+    
+    def get_header_end(self):
+        
+        """
+        Returns position after header line
+        """
+        
+        line_ends = find_line_ends(self.data, 0, self.file_size,
+            block_size=1 << 16, max_count=1
+        )
+        if len(line_ends) > 0:
+            return int(line_ends[0]) + 1
+        
+        return self.file_size
+    
     def read_header(self):
-        line = self.file.readline().decode(self.encoding)
-        self.header = line.strip().split(",")
-        self.header = [ s.strip() for s in self.header ]
+        self.header_end = self.get_header_end()
+        line = self.decode(0, self.header_end)
+        self.header = parse_line(line) if line.strip() != "" else []
     
     def read_file(self):
-        start = self.file.tell()
-        while start < self.file_size:
-            line = self.file.readline()
-            end = self.file.tell()
-            self.lines.append( (start, end - start) )
-            start = end
+        
+        """
+        Find lines offsets. Row index is between offsets[index]
+        and offsets[index + 1]
+        """
+        
+        if self.index and self.load_index():
+            return
+        
+        self.offsets = self.scan_offsets( np.array([self.header_end], dtype=np.int64) )
+        
+        if self.index:
+            self.save_index()
+    
+    def scan_offsets(self, starts):
+        
+        """
+        Scan file after last start and returns all offsets
+        """
+        
+        line_ends = find_line_ends(self.data, int(starts[-1]), self.file_size)
+        offsets = np.concatenate([starts, line_ends + 1])
+        
+        # Last line without new line
+        if offsets[-1] < self.file_size:
+            offsets = np.append(offsets, np.int64(self.file_size))
+        
+        return offsets
+    
+    def get_mtime(self):
+        return os.stat(self.file_name).st_mtime_ns
+    
+    def get_tail_crc(self, size):
+        
+        """
+        Returns crc of file tail before size
+        """
+        
+        start = max(0, size - INDEX_TAIL_SIZE)
+        return zlib.crc32(memoryview(self.data)[start:size]) if size > 0 else 0
+    
+    def read_index_header(self):
+        
+        """
+        Returns index header or None
+        """
+        
+        try:
+            with open(self.index_file, "rb") as file:
+                data = file.read(struct.calcsize(INDEX_HEADER))
+            
+            magic, file_size, mtime, header_end, count, tail_crc = \
+                struct.unpack(INDEX_HEADER, data)
+        
+        except Exception:
+            return None
+        
+        if magic != INDEX_MAGIC:
+            return None
+        
+        return {
+            "file_size": file_size,
+            "mtime": mtime,
+            "header_end": header_end,
+            "count": count,
+            "tail_crc": tail_crc,
+        }
+    
+    def map_index(self, count):
+        
+        """
+        Memory map offsets from index file
+        """
+        
+        self.offsets = np.memmap(
+            self.index_file, dtype=np.int64, mode="r",
+            offset=INDEX_HEADER_SIZE, shape=(count,)
+        )
+        self.index_loaded = True
+    
+    def load_index(self):
+        
+        """
+        Load offsets from index file. Returns False if index is not valid
+        """
+        
+        header = self.read_index_header()
+        if header is None or header["header_end"] != self.header_end:
+            return False
+        
+        try:
+            
+            # Index is valid
+            if header["file_size"] == self.file_size and \
+                header["mtime"] == self.get_mtime():
+                self.map_index(header["count"])
+                return True
+            
+            # Rows were appended to file
+            if header["file_size"] < self.file_size and \
+                header["tail_crc"] == self.get_tail_crc(header["file_size"]):
+                self.map_index(header["count"])
+                self.extend_index(header)
+                return True
+        
+        except Exception:
+            pass
+        
+        self.index_loaded = False
+        return False
+    
+    def extend_index(self, header):
+        
+        """
+        Scan appended rows and write them to index file
+        """
+        
+        starts = self.offsets
+        
+        # Last row may be not finished, so it is scanned again
+        if len(starts) > 1:
+            starts = starts[:-1]
+        
+        # Index file is replaced, so other readers do not see it unfinished
+        self.offsets = self.scan_offsets( np.array(starts) )
+        self.index_loaded = False
+        self.save_index()
+    
+    def get_index_header(self, count):
+        
+        header = struct.pack(INDEX_HEADER,
+            INDEX_MAGIC, self.file_size, self.get_mtime(),
+            self.header_end, count, self.get_tail_crc(self.file_size)
+        )
+        return header + b"\0" * (INDEX_HEADER_SIZE - len(header))
+    
+    def save_index(self):
+        
+        """
+        Save offsets to index file. Index is not saved if folder is read only
+        """
+        
+        tmp_file = self.index_file + "." + str(os.getpid()) + ".tmp"
+        
+        try:
+            with open(tmp_file, "wb") as file:
+                file.write(self.get_index_header(len(self.offsets)))
+                file.write(self.offsets.astype("<i8").tobytes())
+            
+            os.replace(tmp_file, self.index_file)
+        
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            return
+        
+        self.map_index(len(self.offsets))
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file"] = None
+        state["data"] = None
+        
+        # Workers map index file instead of copy of offsets
+        if self.index_loaded:
+            state["offsets"] = len(self.offsets)
+        
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+        
+        if self.index_loaded:
+            self.map_index(state["offsets"])
     
     def __del__(self):
-        del(self.lines)
+        self.close()
     
     def __len__(self):
-        return len(self.lines)
+        return len(self.offsets) - 1
+    
+    def decode(self, start, end):
+        
+        """
+        Decode bytes from start to end without copy of file data
+        """
+        
+        return str(memoryview(self.data)[start:end], self.encoding)
+    
+    def get_row(self, start, end):
+        
+        """
+        Returns row from start to end position
+        """
+        
+        line = parse_line( self.decode(start, end) )
+        return dict(zip(self.header, line))
     
     def __getitem__(self, index):
-        start, length = self.lines[index]
-        self.file.seek(start, 0)
-        line = self.file.read(length)
-        line = line.decode(self.encoding).strip().split(",")
-        line = [ s.strip() for s in line ]
-        
-        obj = {}
-        for i in range(len(line)):
-            key = self.header[i]
-            value = line[i]
-            obj[key] = value
-        
-        return obj
+        
+        if index < 0:
+            index += len(self)
+        
+        if index < 0 or index >= len(self):
+            raise IndexError("CSVReader index out of range")
+        
+        return self.get_row(int(self.offsets[index]), int(self.offsets[index + 1]))
+    
+    def get_rows(self, indices):
+        
+        """
+        Returns rows by indices
+        """
+        
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError("CSVReader index out of range")
+        
+        starts = self.offsets[indices].tolist()
+        ends = self.offsets[indices + 1].tolist()
+        
+        return [ self.get_row(start, end) for start, end in zip(starts, ends) ]
+    
+    def __getitems__(self, indices):
+        return self.get_rows(indices)
+    
+    def to_columns(self, dtypes=None, columns=None, chunk_size=65536,
+        na_values=None, fill_values=None, num_workers=0
+    ):
+        
+        """
+        Read file by chunks to typed numpy arrays.
+        
+        dtypes is dict of column dtype: numpy dtype, "category" or "str".
+        Columns without dtype are str. Category values are encoded to int64
+        codes. Missing values are nan for float, fill value (0 by default)
+        for int, -1 for category and "" for str.
+        
+        If num_workers > 0, chunks are parsed in process pool.
+        
+        Returns columns dict and categories dict of column values list.
+        """
+        
+        if dtypes is None:
+            dtypes = {}
+        
+        if fill_values is None:
+            fill_values = {}
+        
+        if na_values is None:
+            na_values = NA_VALUES
+        
+        if columns is None:
+            columns = self.header
+        
+        count = len(self)
+        res = {}
+        categories_index = {}
+        
+        for name in columns:
+            dtype = dtypes.get(name, "str")
+            if dtype == "category":
+                res[name] = np.empty(count, dtype=np.int64)
+                categories_index[name] = {}
+            elif dtype == "str":
+                res[name] = np.empty(count, dtype=object)
+            else:
+                res[name] = np.empty(count, dtype=np.dtype(dtype))
+        
+        columns_spec = [
+            (name, self.header.index(name), dtypes.get(name, "str"), fill_values.get(name, 0))
+                for name in columns
+        ]
+        args = (len(self.header), columns_spec, na_values)
+        chunks = [
+            (chunk_start, min(chunk_start + chunk_size, count))
+                for chunk_start in range(0, count, chunk_size)
+        ]
+        
+        def add_chunk(chunk_start, chunk_end, values):
+            
+            for name, column in zip(columns, values):
+                
+                # Merge chunk codes to common codes
+                if name in categories_index:
+                    index = categories_index[name]
+                    items, codes = column
+                    codes_map = np.array(
+                        [ index.setdefault(item, len(index)) for item in items ] + [-1],
+                        dtype=np.int64
+                    )
+                    column = codes_map[codes]
+                
+                res[name][chunk_start:chunk_end] = column
+        
+        if num_workers > 0 and len(chunks) > 1:
+            
+            with ProcessPoolExecutor(num_workers) as executor:
+                
+                # Keep limited count of chunks in flight
+                futures = deque()
+                for chunk_start, chunk_end in chunks:
+                    
+                    futures.append((chunk_start, chunk_end, executor.submit(
+                        read_chunk, self.file_name, self.encoding,
+                        int(self.offsets[chunk_start]), int(self.offsets[chunk_end]),
+                        *args
+                    )))
+                    
+                    if len(futures) >= num_workers * 2:
+                        chunk_start, chunk_end, future = futures.popleft()
+                        add_chunk(chunk_start, chunk_end, future.result())
+                
+                while len(futures) > 0:
+                    chunk_start, chunk_end, future = futures.popleft()
+                    add_chunk(chunk_start, chunk_end, future.result())
+        
+        else:
+            for chunk_start, chunk_end in chunks:
+                text = self.decode(int(self.offsets[chunk_start]), int(self.offsets[chunk_end]))
+                add_chunk(chunk_start, chunk_end, parse_chunk(text, *args))
+        
+        categories = {
+            name: list(categories_index[name].keys())
+                for name in categories_index
+        }
+        
+        return res, categories
+
+
+class CSVDataset(torch.utils.data.Dataset):
+    
+    """
+    Dataset of typed csv columns. If x and y are set, item is
+    {"x": x, "y": y}, where x is stacked x columns. Otherwise item is dict
+    of columns values. __getitems__ returns whole batch, so DataLoader
+    should use collate_fn=CSVDataset.collate_fn
+    """
+    
+    def __init__(self, reader, dtypes=None, x=None, y=None, encoding="utf-8", **kwargs):
+        
+        if isinstance(reader, str):
+            reader = CSVReader(reader, encoding)
+        
+        if x is not None or y is not None:
+            columns = []
+            if x is not None:
+                columns += list(x)
+            if y is not None:
+                columns += [ name for name in self.get_list(y) if not (name in columns) ]
+            kwargs["columns"] = columns
+        
+        self.columns, self.categories = reader.to_columns(dtypes=dtypes, **kwargs)
+        self.count = len(reader)
+        self.x = x
+        self.y = y
+        self.x_data = None
+        self.y_data = None
+        
+        if x is not None:
+            self.x_data = np.stack([ self.columns[name] for name in x ], axis=1)
+        
+        if y is not None:
+            if isinstance(y, str):
+                self.y_data = self.columns[y]
+            else:
+                self.y_data = np.stack([ self.columns[name] for name in y ], axis=1)
+    
+    @staticmethod
+    def get_list(value):
+        return [value] if isinstance(value, str) else list(value)
+    
+    @staticmethod
+    def collate_fn(batch):
+        return batch
+    
+    @staticmethod
+    def to_tensor(value):
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            return torch.from_numpy(value)
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.number):
+            return torch.tensor(value)
+        return value
+    
+    def __len__(self):
+        return self.count
+    
+    def get_items(self, indices):
+        
+        if self.x is None and self.y is None:
+            return {
+                name: self.to_tensor(self.columns[name][indices])
+                    for name in self.columns
+            }
+        
+        res = {}
+        if self.x_data is not None:
+            res["x"] = self.to_tensor(self.x_data[indices])
+        if self.y_data is not None:
+            res["y"] = self.to_tensor(self.y_data[indices])
+        
+        return res
+    
+    def __getitem__(self, index):
+        return self.get_items(index)
+    
+    def __getitems__(self, indices):
+        return self.get_items(np.asarray(indices, dtype=np.int64))
+
+
+
+class CSVIterableDataset(torch.utils.data.IterableDataset):
+    
+    """
+    Streaming csv dataset. Rows are read by sequential blocks of block_size
+    bytes in random order of blocks, and are mixed in shuffle buffer
+    of shuffle_size rows. If shuffle_size is 0, rows are read in file order.
+    
+    Rows are split to equal parts between ranks and DataLoader workers,
+    so all ranks have the same count of batches. Last rows, which can not
+    be split between ranks, are skipped. Call set_epoch to get new order
+    if seed is set. Epoch is kept in shared memory, so persistent
+    DataLoader workers see it.
+    """
+    
+    def __init__(self, reader, transform=None, shuffle_size=10000, block_size=1 << 22,
+        seed=None, rank=None, world_size=None, encoding="utf-8"
+    ):
+        
+        if isinstance(reader, str):
+            reader = CSVReader(reader, encoding)
+        
+        self.reader = reader
+        self.transform = transform
+        self.shuffle_size = shuffle_size
+        self.block_size = block_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.shared_epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+    
+    @property
+    def epoch(self):
+        return int(self.shared_epoch[0])
+    
+    def set_epoch(self, epoch):
+        self.shared_epoch[0] = epoch
+        return self
+    
+    def get_world(self):
+        
+        """
+        Returns rank and world size
+        """
+        
+        if self.world_size is not None:
+            return (self.rank if self.rank is not None else 0), self.world_size
+        
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        
+        return 0, 1
+    
+    def get_bounds(self, row_start, row_end, count):
+        
+        """
+        Split rows to count parts of the same byte size.
+        Returns rows bounds.
+        """
+        
+        offsets = self.reader.offsets
+        start = int(offsets[row_start])
+        end = int(offsets[row_end])
+        
+        bounds = start + (end - start) * np.arange(count + 1, dtype=np.int64) // count
+        rows = row_start + np.searchsorted(offsets[row_start:row_end], bounds)
+        rows[-1] = row_end
+        
+        return rows
+    
+    def get_shard(self, worker_id=0, num_workers=1):
+        
+        """
+        Returns rows range of DataLoader worker of current rank
+        """
+        
+        rank, world_size = self.get_world()
+        count = len(self.reader) // world_size
+        row_start = rank * count
+        
+        return row_start + count * worker_id // num_workers, \
+            row_start + count * (worker_id + 1) // num_workers
+    
+    def __len__(self):
+        row_start, row_end = self.get_shard()
+        return row_end - row_start
+    
+    def read_block(self, row_start, row_end):
+        
+        """
+        Returns rows of block
+        """
+        
+        reader = self.reader
+        text = reader.decode(int(reader.offsets[row_start]), int(reader.offsets[row_end]))
+        columns = parse_lines(text, len(reader.header))
+        
+        for row in zip(*columns):
+            item = dict(zip(reader.header, [ value.strip() for value in row ]))
+            if self.transform:
+                item = self.transform(item)
+            yield item
+    
+    def __iter__(self):
+        
+        rank, world_size = self.get_world()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        
+        shard = rank * num_workers + worker_id
+        row_start, row_end = self.get_shard(worker_id, num_workers)
+        
+        seed = None
+        if self.seed is not None:
+            seed = [self.seed, self.epoch, shard]
+        
+        rng = np.random.default_rng(seed)
+        
+        # Blocks
+        offsets = self.reader.offsets
+        size = int(offsets[row_end]) - int(offsets[row_start])
+        blocks_count = max(1, -(-size // self.block_size))
+        rows = np.unique(self.get_bounds(row_start, row_end, blocks_count))
+        blocks = list(zip(rows[:-1].tolist(), rows[1:].tolist()))
+        
+        if self.shuffle_size <= 0:
+            for block_start, block_end in blocks:
+                yield from self.read_block(block_start, block_end)
+            return
+        
+        # Shuffle buffer
+        buffer = []
+        for index in rng.permutation(len(blocks)).tolist():
+            for item in self.read_block(*blocks[index]):
+                if len(buffer) < self.shuffle_size:
+                    buffer.append(item)
+                    continue
+                
+                pos = int(rng.integers(len(buffer)))
+                yield buffer[pos]
+                buffer[pos] = item
+        
+        for index in rng.permutation(len(buffer)).tolist():
+            yield buffer[index]
+
+def benchmark(file_names, dtypes=None, num_workers=4, chunk_size=65536, encoding="utf-8"):
+    
+    """
+    Compare time of read csv files by rows, by columns and by columns
+    in num_workers processes
+    """
+    
+    print("{:<30} {:>10} {:>10} {:>10} {:>10}".format(
+        "File", "Rows", "Rows, s", "Columns, s", "Parallel, s"
+    ))
+    
+    for file_name in file_names:
+        
+        reader = CSVReader(file_name, encoding, index=False)
+        count = len(reader)
+        
+        time_start = time.time()
+        for i in range(count):
+            reader[i]
+        time_rows = time.time() - time_start
+        
+        time_start = time.time()
+        reader.to_columns(dtypes=dtypes, chunk_size=chunk_size)
+        time_columns = time.time() - time_start
+        
+        time_start = time.time()
+        reader.to_columns(dtypes=dtypes, chunk_size=chunk_size, num_workers=num_workers)
+        time_parallel = time.time() - time_start
+        
+        print("{:<30} {:>10} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            os.path.basename(file_name), count, time_rows, time_columns, time_parallel
+        ))
+        
+        reader.close()
@@ -7,7 +7,6 @@
 ##
 
 import torch
-import numpy as np
 from typing import overload
 from PIL import Image, ImageDraw
 
@@ -99,33 +98,75 @@ class ReadImage(torch.nn.Module):
         torch.nn.Module.__init__(self)
         self.mode=mode
     
+    def read(self, t):
+        
+        t = Image.open(t)
+        
+        if self.mode is not None and self.mode != t.mode:
+            t = t.convert(self.mode)
+        else:
+            t.load()
+        
+        return t
+    
     def forward(self, batch):
         
-        res = []
-        for t in batch:
+        from .utils import thread_map
         
-            t = Image.open(t)
-            
-            if self.mode is not None and self.mode != t.mode:
-                t = t.convert(self.mode)
-            
-            res.append(t)
+        return thread_map(self.read, batch)
+
+
+class ReadImageBatch(torch.nn.Module):
+    
+    """
+    Read, resize and convert images to uint8 tensor in thread pool.
+    Result is the same as ReadImage, ResizeImage and ImageToTensor,
+    but JPEG is decoded at reduced scale and images are written
+    to batch tensor directly. If cache is set, images are read
+    from ImageCache.
+    """
+    
+    def __init__(self, size=None, mode=None, contain=True, color=None,
+        draft=True, num_workers=None, cache=None
+    ):
+        torch.nn.Module.__init__(self)
+        self.size = size
+        self.mode = mode
+        self.contain = contain
+        self.color = color
+        self.draft = draft
+        self.num_workers = num_workers
+        self.cache = cache
+    
+    def forward(self, batch):
         
-        return res
+        from .utils import read_images
+        
+        if self.cache is not None:
+            return self.cache.read_images(batch, self.size, mode=self.mode,
+                contain=self.contain, color=self.color, draft=self.draft,
+                num_workers=self.num_workers)
+        
+        return read_images(batch, self.size, mode=self.mode, contain=self.contain,
+            color=self.color, draft=self.draft, num_workers=self.num_workers)
 
 
 class ImageToTensor(torch.nn.Module):
     
+    """
+    Convert list of images to batch tensor of dtype.
+    Use dtype=torch.uint8 to get batch without convert.
+    """
+    
+    def __init__(self, dtype=torch.float32):
+        torch.nn.Module.__init__(self)
+        self.dtype = dtype
+    
     def forward(self, batch):
         
-        res = torch.tensor([])
-        for t in batch:
+        from .utils import images_to_batch
             
-            t = torch.from_numpy( np.array(t) )
-            t = t[None, :]
-            res = torch.cat( (res, t) )
-        
-        return res
+        return images_to_batch(batch, dtype=self.dtype)
 
 
 class ResizeImage(torch.nn.Module):
@@ -140,14 +181,12 @@ class ResizeImage(torch.nn.Module):
     
     def forward(self, batch):
         
-        from .utils import resize_image
+        from .utils import resize_image, thread_map
         
-        res = []
-        for t in batch:
-            t = resize_image(t, self.size, contain=self.contain, color=self.color)
-            res.append(t)
-        
-        return res
+        return thread_map(
+            lambda t: resize_image(t, self.size, contain=self.contain, color=self.color),
+            batch
+        )
 
 
 class NormalizeImage(torch.nn.Module):
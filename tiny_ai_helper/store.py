@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+##
+# Tiny ai helper
+# Copyright (с) Ildar Bikmamatov 2022 - 2023 <support@bayrell.org>
+# License: MIT
+##
+
+import json, os, torch
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from torch.utils.data import Dataset
+
+
+STORE_VERSION = 1
+worker_dataset = None
+
+
+def get_item_fields(item):
+    
+    """
+    Returns kind of item and list of fields
+    """
+    
+    if isinstance(item, dict):
+        return "dict", list(item.items())
+    
+    if isinstance(item, (tuple, list)):
+        return "tuple", [ (str(index), value) for index, value in enumerate(item) ]
+    
+    return "value", [ ("value", item) ]
+
+
+def to_numpy(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    return np.asarray(value)
+
+
+def get_field_dtype(name, dtype, value_dtype):
+    
+    """
+    Returns dtype, which holds values of field of both dtypes. Numbers
+    are promoted to common number type, strings to the longest string.
+    """
+    
+    if dtype == value_dtype:
+        return dtype
+    
+    numbers = "biufc"
+    if (dtype.kind in numbers and value_dtype.kind in numbers) or \
+        dtype.kind == value_dtype.kind:
+        return np.result_type(dtype, value_dtype)
+    
+    raise ValueError("Field " + name + " has values of different types " +
+        dtype.str + " and " + value_dtype.str)
+
+
+def get_shard_path(path, shard, name, suffix=".npy"):
+    return os.path.join(path, "shard_" + str(shard).zfill(5) + "_" + name + suffix)
+
+
+def save_npy(file_name, value):
+    
+    """
+    Save npy file with rename, so file is not read unfinished
+    """
+    
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, "wb") as file:
+        np.save(file, value)
+    os.replace(tmp_file, file_name)
+
+
+def write_shard(dataset, path, shard, start, end):
+    
+    """
+    Write items of dataset from start to end to shard files.
+    Field with the same shape of items is written to memory map
+    of shape (count, *shape). Field with different shape is written
+    as values concatenated by first axis and offsets. If dtype of item
+    is changed, dtype of field is promoted. None and objects are not
+    supported.
+    """
+    
+    count = end - start
+    kind = None
+    fields = {}
+    
+    for pos in range(count):
+        
+        item_kind, items = get_item_fields(dataset[start + pos])
+        if kind is None:
+            kind = item_kind
+        
+        for name, value in items:
+            
+            value = to_numpy(value)
+            field = fields.get(name)
+            
+            if value.dtype.kind == "O":
+                raise ValueError("Field " + name + " of item " + str(start + pos) +
+                    " is None or object, which can not be saved")
+            
+            # Create memory map from first item
+            if field is None:
+                file_name = get_shard_path(path, shard, name, ".tmp.npy")
+                data = np.lib.format.open_memmap(file_name, mode="w+",
+                    dtype=value.dtype, shape=(count,) + value.shape)
+                field = {"data": data, "file_name": file_name, "items": None,
+                    "dtype": value.dtype}
+                fields[name] = field
+            
+            dtype = get_field_dtype(name, field["dtype"], value.dtype)
+            
+            # Switch to variable shape
+            if field["items"] is None and value.shape != field["data"].shape[1:]:
+                if value.ndim == 0 or field["data"].ndim == 1:
+                    raise ValueError("Field " + name + " has scalar and array values")
+                field["items"] = [ np.array(item) for item in field["data"][:pos] ]
+                del field["data"]
+                os.unlink(field["file_name"])
+            
+            # Promote dtype of memory map
+            if field["items"] is None and dtype != field["dtype"]:
+                
+                # Reserve length of strings, so field is not copied for each item
+                if dtype.kind in "US":
+                    dtype = np.dtype((dtype.type, max(dtype.itemsize, field["dtype"].itemsize * 2)
+                        // np.dtype((dtype.type, 1)).itemsize))
+                
+                items = np.array(field["data"][:pos])
+                shape = field["data"].shape
+                del field["data"]
+                field["data"] = np.lib.format.open_memmap(field["file_name"], mode="w+",
+                    dtype=dtype, shape=shape)
+                field["data"][:pos] = items
+            
+            field["dtype"] = dtype
+            
+            if field["items"] is None:
+                field["data"][pos] = value
+            else:
+                field["items"].append(value)
+    
+    res = {"start": start, "count": count, "kind": kind, "fields": {}}
+    for name, field in fields.items():
+        
+        file_name = get_shard_path(path, shard, name)
+        
+        if field["items"] is None:
+            field["data"].flush()
+            dtype = field["dtype"]
+            del field["data"]
+            os.replace(field["file_name"], file_name)
+            res["fields"][name] = {"dtype": dtype.str, "variable": False}
+        
+        else:
+            items = field["items"]
+            offsets = np.zeros(count + 1, dtype=np.int64)
+            np.cumsum([ len(item) for item in items ], out=offsets[1:])
+            save_npy(get_shard_path(path, shard, name + "_offsets"), offsets)
+            save_npy(file_name, np.concatenate(items, dtype=field["dtype"]))
+            res["fields"][name] = {"dtype": field["dtype"].str, "variable": True}
+    
+    return res
+
+
+def init_worker(dataset):
+    global worker_dataset
+    worker_dataset = dataset
+
+
+def write_shard_worker(path, shard, start, end):
+    return write_shard(worker_dataset, path, shard, start, end)
+
+
+def materialize(dataset, path, shard_size=4096, num_workers=0, overwrite=False):
+    
+    """
+    Run dataset transforms once and save items to memory mapped npy shards
+    in path. Item may be tensor, tuple or dict of tensors or numpy arrays.
+    Items of variable length are saved with offsets.
+    If store already exists, it is opened without transforms.
+    Returns MaterializedDataset.
+    """
+    
+    index_file = os.path.join(path, "index.json")
+    if os.path.exists(index_file) and not overwrite:
+        return MaterializedDataset(path)
+    
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(index_file):
+        os.unlink(index_file)
+    
+    count = len(dataset)
+    shards = [
+        (shard, start, min(start + shard_size, count))
+            for shard, start in enumerate(range(0, count, shard_size))
+    ]
+    
+    if num_workers > 0 and len(shards) > 1:
+        with ProcessPoolExecutor(num_workers, initializer=init_worker,
+            initargs=(dataset,)
+        ) as executor:
+            futures = [
+                executor.submit(write_shard_worker, path, shard, start, end)
+                    for shard, start, end in shards
+            ]
+            res = [ future.result() for future in futures ]
+    else:
+        res = [
+            write_shard(dataset, path, shard, start, end)
+                for shard, start, end in shards
+        ]
+    
+    index = {
+        "version": STORE_VERSION,
+        "count": count,
+        "shards": res,
+    }
+    
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(index, file, indent=2)
+    os.replace(tmp_file, index_file)
+    
+    return MaterializedDataset(path)
+
+
+class MaterializedDataset(Dataset):
+    
+    """
+    Dataset of materialized items. Shards are opened as memory map,
+    items are returned as torch tensors without copy. String fields
+    are returned as str or list of str.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.shards = None
+        
+        with open(os.path.join(path, "index.json")) as file:
+            self.index = json.load(file)
+        
+        self.starts = np.array([ shard["start"] for shard in self.index["shards"] ],
+            dtype=np.int64)
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+    
+    def open(self):
+        
+        """
+        Open shards as memory map
+        """
+        
+        self.shards = []
+        for shard, item in enumerate(self.index["shards"]):
+            fields = {}
+            for name, field in item["fields"].items():
+                file_name = get_shard_path(self.path, shard, name)
+                try:
+                    data = np.load(file_name, mmap_mode="c")
+                except ValueError:
+                    # Empty array can not be mapped
+                    data = np.load(file_name)
+                offsets = None
+                if field["variable"]:
+                    offsets = np.load(get_shard_path(self.path, shard, name + "_offsets"))
+                fields[name] = (data, offsets)
+            self.shards.append(fields)
+    
+    def __len__(self):
+        return self.index["count"]
+    
+    def __getitem__(self, index):
+        
+        if index < 0:
+            index += len(self)
+        
+        if index < 0 or index >= len(self):
+            raise IndexError("MaterializedDataset index out of range")
+        
+        if self.shards is None:
+            self.open()
+        
+        shard = int(np.searchsorted(self.starts, index, side="right")) - 1
+        pos = index - int(self.starts[shard])
+        
+        res = {}
+        for name, (data, offsets) in self.shards[shard].items():
+            if offsets is None:
+                value = data[pos]
+            else:
+                value = data[offsets[pos]:offsets[pos + 1]]
+            value = np.asarray(value)
+            if value.dtype.kind in "US":
+                res[name] = value.tolist()
+            else:
+                res[name] = torch.from_numpy(value)
+        
+        kind = self.index["shards"][shard]["kind"]
+        if kind == "tuple":
+            return tuple( res[str(index)] for index in range(len(res)) )
+        
+        if kind == "value":
+            return res["value"]
+        
+        return res
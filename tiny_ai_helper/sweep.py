@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+##
+# Tiny ai helper
+# Copyright (с) Ildar Bikmamatov 2022 - 2023 <support@bayrell.org>
+# License: MIT
+##
+
+import copy, inspect, itertools, math, os, random, torch
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from torch import nn
+from .Model import Model
+from .utils import fit
+
+
+class LogUniform:
+    
+    """
+    Random value from low to high with uniform distribution of logarithm.
+    May be used in random search space, for example for learning rate.
+    """
+    
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+    
+    def __call__(self, rng):
+        return math.exp(rng.uniform(math.log(self.low), math.log(self.high)))
+
+
+def grid_space(space):
+    
+    """
+    Returns list of all combinations of space values.
+    Space is dict of name and list of values. Functions of random
+    generator, like LogUniform, are supported only by random_space.
+    """
+    
+    for name, value in space.items():
+        if callable(value):
+            raise ValueError("Grid space value " + str(name) +
+                " is function, set count for random search")
+    
+    names = list(space.keys())
+    values = [ space[name] if isinstance(space[name], (list, tuple)) \
+        else [space[name]] for name in names ]
+    
+    return [ dict(zip(names, item)) for item in itertools.product(*values) ]
+
+
+def random_space(space, count, seed=None):
+    
+    """
+    Returns count random params from space. Space value may be list of values,
+    tuple (low, high) of uniform distribution, function of random generator
+    or single value.
+    """
+    
+    rng = random.Random(seed)
+    
+    def get_value(value):
+        if isinstance(value, list):
+            return rng.choice(value)
+        if isinstance(value, tuple):
+            if isinstance(value[0], int) and isinstance(value[1], int):
+                return rng.randint(value[0], value[1])
+            return rng.uniform(value[0], value[1])
+        if callable(value):
+            return value(rng)
+        return value
+    
+    return [
+        { name: get_value(value) for name, value in space.items() }
+            for _ in range(count)
+    ]
+
+
+def get_run_name(params):
+    
+    """
+    Returns run name from params, which is used as model prefix name
+    """
+    
+    def get_value(value):
+        if isinstance(value, float):
+            return "{:.4g}".format(value)
+        return str(value)
+    
+    name = "_".join([ key + "=" + get_value(value) for key, value in params.items() ])
+    return "".join([ c if c.isalnum() or c in "=-_." else "-" for c in name ])
+
+
+def get_cpu_groups(max_workers, num_threads=None):
+    
+    """
+    Split available CPU cores between workers
+    """
+    
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    
+    if num_threads is None:
+        num_threads = max(1, len(cores) // max_workers)
+    
+    return [
+        [ cores[(index * num_threads + pos) % len(cores)] for pos in range(num_threads) ]
+            for index in range(max_workers)
+    ]
+
+
+def init_sweep_worker(cpu_groups):
+    
+    """
+    Pin worker process to its own CPU cores
+    """
+    
+    cores = cpu_groups.get()
+    
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError:
+            pass
+    
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    torch.set_num_threads(len(cores))
+
+
+def run_sweep_item(factory, params, run_name, repository_path, fit_params):
+    
+    """
+    Create model by factory and train it. Params, which are names of fit
+    arguments, are passed to fit too. Returns run result.
+    """
+    
+    fit_names = inspect.signature(fit).parameters
+    fit_params = fit_params.copy()
+    fit_params.update({ key: value for key, value in params.items() if key in fit_names })
+    
+    # Each run has own callbacks
+    callbacks = fit_params.get("callbacks")
+    if callable(callbacks):
+        fit_params["callbacks"] = callbacks()
+    elif callbacks is not None:
+        fit_params["callbacks"] = copy.deepcopy(callbacks)
+    
+    res = {
+        "name": run_name,
+        "params": params,
+        "model_path": None,
+        "error": None,
+    }
+    
+    try:
+        model = factory(params)
+        model.set_repository_path(repository_path)
+        model.set_prefix_name(run_name)
+        res["model_path"] = model.model_path
+        
+        os.makedirs(model.model_path, exist_ok=True)
+        fit(model, **fit_params)
+        model.save_history()
+    
+    except Exception as e:
+        res["error"] = repr(e)
+    
+    return res
+
+
+def load_sweep_history(model_path, best_metrics=None):
+    
+    """
+    Returns history and the best epoch of run
+    """
+    
+    model = Model(nn.Identity())
+    model.set_path(model_path)
+    
+    index = model.load_history_index()
+    if index is None:
+        return None, None
+    
+    model.load_history()
+    if best_metrics is None:
+        return model.history, index["best_epoch"]
+    
+    return model.history, model.get_the_best_epoch(best_metrics)
+
+
+def get_sweep_table(results, best_metrics=None):
+    
+    """
+    Returns sweep results sorted by the best epoch of each run.
+    Runs are ranked by the same rule as get_the_best_epoch.
+    """
+    
+    if best_metrics is None:
+        best_metrics = ["val_acc", "epoch"]
+    
+    for item in results:
+        item["best_epoch"] = None
+        item["best"] = None
+        if item["model_path"] is None:
+            continue
+        
+        history, best_epoch = load_sweep_history(item["model_path"], best_metrics)
+        if history is not None and best_epoch in history:
+            item["best_epoch"] = best_epoch
+            item["best"] = history[best_epoch]
+    
+    # Rank the best epochs of runs as epochs of one history
+    model = Model(nn.Identity())
+    model.history = {
+        index: item["best"] for index, item in enumerate(results)
+            if item["best"] is not None
+    }
+    
+    order = model.get_the_best_epochs_indexes(len(results), best_metrics)
+    order += [ index for index in range(len(results)) if index not in order ]
+    
+    return [ results[index] for index in order ]
+
+
+def print_sweep_table(table, metrics=None):
+    
+    """
+    Print sweep comparison table
+    """
+    
+    if metrics is None:
+        metrics = ["train_loss", "val_loss", "train_acc", "val_acc"]
+    
+    name_size = max([ len(item["name"]) for item in table ] + [4])
+    print (("{:<" + str(name_size) + "} {:>5}").format("name", "epoch") + \
+        "".join([ " {:>10}".format(name) for name in metrics ]))
+    
+    for item in table:
+        
+        s = ("{:<" + str(name_size) + "} ").format(item["name"])
+        
+        if item["best"] is None:
+            s += "error " + str(item["error"]) if item["error"] is not None \
+                else "no history"
+            print (s)
+            continue
+        
+        s += "{:>5}".format(item["best_epoch"])
+        for name in metrics:
+            value = item["best"].get(name, 0)
+            s += " {:>10}".format(round(value, 6) if isinstance(value, float) else value)
+        
+        print (s)
+
+
+def sweep(factory, space, count=None, max_workers=1, num_threads=None,
+    repository_path="sweep", best_metrics=None, seed=None, show=True,
+    **fit_params
+):
+    
+    """
+    Train model for each params of search space and returns runs sorted
+    by the best epoch.
+    
+    factory(params) must return Model with optimizer and loss. Params,
+    which are fit arguments, like batch_size or epochs, are passed to fit.
+    Other kwargs are passed to fit of each run. callbacks may be function,
+    which returns list of callbacks for run. If count is set, count
+    random params are taken from space, otherwise all grid combinations.
+    Grid space must not contain functions, like LogUniform.
+    
+    Runs are executed in max_workers processes. Each process is pinned
+    to num_threads CPU cores. Each run is saved in own model path inside
+    repository_path. If max_workers is 0, runs are executed in current
+    process. factory must be module level function.
+    """
+    
+    if count is None:
+        runs = grid_space(space)
+    else:
+        runs = random_space(space, count, seed=seed)
+    
+    runs = [ (get_run_name(params), params) for params in runs ]
+    
+    if max_workers > 0:
+        ctx = multiprocessing.get_context("spawn")
+        cpu_groups = ctx.Queue()
+        for cores in get_cpu_groups(max_workers, num_threads):
+            cpu_groups.put(cores)
+        
+        with ProcessPoolExecutor(max_workers, mp_context=ctx,
+            initializer=init_sweep_worker, initargs=(cpu_groups,)
+        ) as executor:
+            futures = [
+                executor.submit(run_sweep_item, factory, params, run_name,
+                    repository_path, fit_params)
+                    for run_name, params in runs
+            ]
+            results = [ future.result() for future in futures ]
+    
+    else:
+        results = [
+            run_sweep_item(factory, params, run_name, repository_path, fit_params)
+                for run_name, params in runs
+        ]
+    
+    table = get_sweep_table(results, best_metrics)
+    
+    if show:
+        print_sweep_table(table)
+    
+    return table
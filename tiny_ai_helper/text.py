@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+##
+# Tiny ai helper
+# Copyright (с) Ildar Bikmamatov 2022 - 2023 <support@bayrell.org>
+# License: MIT
+##
+
+import re, struct, torch
+import numpy as np
+from collections import Counter
+from itertools import repeat
+from multiprocessing import Pool
+from .utils import ragged_rows
+
+
+VOCABULARY_MAGIC = b"TAHVOC01"
+VOCABULARY_HEADER = "<8sqqq"
+
+
+def tokenize(text):
+    
+    """
+    Split text to lower case words
+    """
+    
+    return re.findall(r"\w+", text.lower())
+
+
+def count_words(texts, tokenizer=tokenize):
+    
+    """
+    Returns words counts of texts
+    """
+    
+    counter = Counter()
+    for text in texts:
+        counter.update(tokenizer(text))
+    
+    return counter
+
+
+class Vocabulary:
+    
+    """
+    Words vocabulary. Index 0 is empty value. If unk is set, unknown words
+    are encoded as index 1, otherwise unknown words are skipped.
+    
+    Vocabulary may be used as dictionary in dictionary_encoder.
+    """
+    
+    def __init__(self, words=None, counts=None, unk=None, tokenizer=tokenize):
+        self.unk = unk
+        self.tokenizer = tokenizer
+        self.words = [""]
+        self.counts = [0]
+        self.index = {}
+        
+        if unk is not None:
+            self.words.append(unk)
+            self.counts.append(0)
+        
+        if words is not None:
+            self.words += list(words)
+            self.counts += list(counts) if counts is not None else [0] * len(words)
+        
+        self.update_index()
+    
+    def update_index(self):
+        self.index = { word: index for index, word in enumerate(self.words) if index > 0 }
+    
+    def build(self, texts, min_freq=1, max_size=None, num_workers=0, chunk_size=10000):
+        
+        """
+        Build vocabulary from texts. Words are sorted by count.
+        Words with count less than min_freq are skipped. max_size is max count
+        of words without empty and unk values.
+        If num_workers > 0, words are counted in process pool.
+        """
+        
+        if num_workers > 0:
+            chunks = [ texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size) ]
+            counter = Counter()
+            with Pool(num_workers) as pool:
+                for chunk_counter in pool.starmap(
+                    count_words, zip(chunks, repeat(self.tokenizer))
+                ):
+                    counter.update(chunk_counter)
+        else:
+            counter = count_words(texts, self.tokenizer)
+        
+        if self.unk is not None and self.unk in counter:
+            del counter[self.unk]
+        
+        items = [ item for item in counter.items() if item[1] >= min_freq ]
+        items.sort(key=lambda item: (-item[1], item[0]))
+        
+        if max_size is not None:
+            items = items[:max_size]
+        
+        self.words = self.words[:2 if self.unk is not None else 1]
+        self.counts = self.counts[:len(self.words)]
+        self.words += [ item[0] for item in items ]
+        self.counts += [ item[1] for item in items ]
+        self.update_index()
+        
+        return self
+    
+    def __len__(self):
+        return len(self.words)
+    
+    def __contains__(self, word):
+        return word in self.index
+    
+    def __getitem__(self, word):
+        return self.index[word]
+    
+    def get(self, word, default=None):
+        return self.index.get(word, default)
+    
+    def save(self, file_name):
+        
+        """
+        Save vocabulary to binary file
+        """
+        
+        data = "\0".join(self.words).encode("utf-8")
+        counts = np.array(self.counts, dtype=np.int64)
+        unk = 1 if self.unk is not None else 0
+        
+        with open(file_name, "wb") as file:
+            file.write(struct.pack(VOCABULARY_HEADER, VOCABULARY_MAGIC,
+                len(self.words), len(data), unk))
+            file.write(counts.tobytes())
+            file.write(data)
+    
+    def load(self, file_name):
+        
+        """
+        Load vocabulary from binary file
+        """
+        
+        with open(file_name, "rb") as file:
+            
+            header = file.read(struct.calcsize(VOCABULARY_HEADER))
+            magic, count, size, unk = struct.unpack(VOCABULARY_HEADER, header)
+            
+            if magic != VOCABULARY_MAGIC:
+                raise ValueError("Wrong vocabulary file " + file_name)
+            
+            counts = np.frombuffer(file.read(count * 8), dtype=np.int64)
+            words = file.read(size).decode("utf-8").split("\0")
+        
+        self.words = words
+        self.counts = counts.tolist()
+        self.unk = words[1] if unk else None
+        self.update_index()
+        
+        return self
+    
+    def encode_words(self, words):
+        
+        """
+        Returns words indexes. Unknown words are -1, if unk is not set
+        """
+        
+        default = 1 if self.unk is not None else -1
+        return np.fromiter(
+            map(self.index.get, words, repeat(default)),
+            dtype=np.int64, count=len(words)
+        )
+    
+    def encode(self, texts, max_words=None, packed=False, tokenized=False):
+        
+        """
+        Encode batch of texts to int64 tensor of padded words indexes.
+        If packed is True, returns offsets and values, like ragged_batch.
+        Unknown words are skipped, if unk is not set. Only first max_words
+        encoded words of text are kept.
+        """
+        
+        if not tokenized:
+            texts = [ self.tokenizer(text) for text in texts ]
+        
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        words = [ word for text in texts for word in text ]
+        
+        index = self.encode_words(words)
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        mask = index >= 0
+        
+        index = torch.from_numpy(index[mask])
+        lengths = torch.from_numpy(np.bincount(rows[mask], minlength=len(texts)))
+        offsets = torch.zeros(len(texts) + 1, dtype=torch.int64)
+        torch.cumsum(lengths, 0, out=offsets[1:])
+        
+        # Keep first max_words indexes of texts
+        if max_words is not None:
+            text_offsets = offsets
+            lengths = lengths.clamp(max=max_words)
+            offsets = torch.zeros(len(texts) + 1, dtype=torch.int64)
+            torch.cumsum(lengths, 0, out=offsets[1:])
+            rows, pos = ragged_rows(offsets)
+            index = index[text_offsets[rows] + pos]
+        
+        if packed:
+            return offsets, index
+        
+        rows, pos = ragged_rows(offsets)
+        size = max_words
+        if size is None:
+            size = int(lengths.max()) if len(texts) > 0 else 0
+        
+        t = torch.zeros(len(texts), size, dtype=torch.int64)
+        t[rows, pos] = index
+        
+        return t
+    
+    def encoder(self, max_words=None, packed=False):
+        
+        """
+        Returns batch encoder of texts, which may be used in batch_collate
+        """
+        
+        def f(texts):
+            return self.encode(texts, max_words=max_words, packed=packed)
+        
+        return f
@@ -6,11 +6,14 @@
 # License: MIT
 ##
 
-import torch, math, json, os, re, time
+import torch, math, json, os, re, time, contextlib, copy, gc, random, queue, threading
+import hashlib, warnings
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from torch import nn
 from torch.utils.data import Dataset, DataLoader
-from PIL import Image, ImageDraw
+from PIL import Image, ImageColor, ImageDraw
 
 
 class TransformDataset(torch.utils.data.Dataset):
@@ -36,12 +39,158 @@ class TransformDataset(torch.utils.data.Dataset):
         return len(self.dataset)
 
 
+class WorkerInit:
+    
+    """
+    DataLoader worker init. Seeds numpy and random in worker,
+    so workers do not produce the same random values.
+    If seed is None, worker is seeded from torch seed, which is new every epoch.
+    """
+    
+    def __init__(self, seed=None):
+        self.seed = seed
+    
+    def __call__(self, worker_id):
+        
+        if self.seed is None:
+            worker_seed = torch.initial_seed() % 2**32
+        else:
+            worker_seed = (self.seed + worker_id) % 2**32
+        
+        np.random.seed(worker_seed)
+        random.seed(worker_seed)
+
+
+class RandomSubsetSampler(torch.utils.data.Sampler):
+    
+    """
+    Returns new random subset of count indexes every epoch
+    """
+    
+    def __init__(self, total_count, count):
+        self.total_count = total_count
+        self.count = count
+    
+    def __iter__(self):
+        indices = np.random.permutation(self.total_count)[:self.count]
+        return iter(indices.tolist())
+    
+    def __len__(self):
+        return min(self.count, self.total_count)
+
+
+def create_loader(dataset, batch_size=64, collate_fn=None, shuffle=False,
+    drop_last=False, sampler=None, num_workers=0, pin_memory=None,
+    prefetch_factor=None, persistent_workers=None, worker_seed=None,
+    distributed=False, **kwargs
+):
+    
+    """
+    Create DataLoader.
+    pin_memory is enabled by default if cuda is available.
+    Workers are persistent by default, so they are not created every epoch.
+    Workers of iterable dataset are not persistent by default, because
+    state, which is set on dataset between epochs, is not seen by persistent
+    workers, unless it is kept in shared memory like in CSVIterableDataset.
+    If worker_seed is set, shuffle and worker random values are reproducible.
+    Iterable dataset is not shuffled by loader, it shuffles rows itself.
+    If distributed, dataset is split between processes by DistributedSampler.
+    """
+    
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        shuffle = False
+    
+    elif distributed and sampler is None and is_distributed():
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, shuffle=shuffle,
+            seed=worker_seed if worker_seed is not None else 0
+        )
+        shuffle = False
+    
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    
+    if num_workers > 0:
+        
+        if persistent_workers is None:
+            persistent_workers = not isinstance(dataset, torch.utils.data.IterableDataset)
+        
+        kwargs["persistent_workers"] = persistent_workers
+        kwargs["worker_init_fn"] = WorkerInit(worker_seed)
+        
+        if prefetch_factor is not None:
+            kwargs["prefetch_factor"] = prefetch_factor
+    
+    if worker_seed is not None:
+        kwargs["generator"] = torch.Generator().manual_seed(worker_seed)
+    
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        collate_fn=collate_fn,
+        drop_last=drop_last,
+        shuffle=shuffle,
+        sampler=sampler,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **kwargs
+    )
+
+
+class TensorBuffer:
+    
+    """
+    Tensor with preallocated capacity. Capacity is doubled when buffer
+    is full, so append does not copy all items every time.
+    """
+    
+    def __init__(self, capacity=16):
+        self.data = None
+        self.count = 0
+        self.capacity = capacity
+    
+    def append(self, t):
+        
+        if self.data is None:
+            self.data = torch.empty((self.capacity,) + tuple(t.shape),
+                dtype=t.dtype, device=t.device)
+        
+        if self.count == len(self.data):
+            data = torch.empty((len(self.data) * 2,) + tuple(self.data.shape[1:]),
+                dtype=self.data.dtype, device=self.data.device)
+            data[:self.count] = self.data
+            self.data = data
+        
+        self.data[self.count] = t
+        self.count += 1
+        
+        return self
+    
+    def tensor(self):
+        
+        """
+        Returns tensor of appended items
+        """
+        
+        if self.data is None:
+            return torch.tensor([])
+        
+        return self.data[:self.count]
+    
+    def __len__(self):
+        return self.count
+
+
 def append_tensor(res, t):
     
     """
-    Append tensor
+    Append tensor. If res is TensorBuffer, t is appended to buffer without
+    copy of previous items.
     """
     
+    if isinstance(res, TensorBuffer):
+        return res.append(t)
+    
     t = t[None, :]
     res = torch.cat( (res, t) )
     return res
@@ -143,306 +292,1466 @@ def dictionary_encoder(dictionary, max_words):
     return f
 
 
-def batch_map(f):
-    
-    def transform(batch_x):
-        
-        res = torch.tensor([])
-        
-        for i in range(len(batch_x)):
-            x = f(batch_x[i])
-            x = x[None, :]
-            res = torch.cat( (res, x) )
-        
-        return res.to(batch_x.device)
-    
-    return transform
-
-
-def batch_to(x, device):
+def ragged_batch(batch, dtype=torch.int64):
     
     """
-    Move batch to device
+    Convert batch of lists to offsets and values.
+    Row i is values[offsets[i]:offsets[i+1]].
+    If batch is already tuple of offsets and values, it is returned as is.
     """
     
-    if isinstance(x, list) or isinstance(x, tuple):
-        for i in range(len(x)):
-            x[i] = x[i].to(device)
-    else:
-        x = x.to(device)
+    if isinstance(batch, tuple) and len(batch) == 2 and isinstance(batch[0], torch.Tensor):
+        return batch
     
-    return x
-
-
-def tensor_size(t):
-
-    """
-    Returns tensor size
-    """
+    lengths = torch.tensor([ len(item) for item in batch ], dtype=torch.int64)
+    offsets = torch.zeros(len(batch) + 1, dtype=torch.int64)
+    torch.cumsum(lengths, 0, out=offsets[1:])
     
-    if not isinstance(t, torch.Tensor):
-        return 0, 0
+    values = [ value for item in batch for value in item ]
+    if dtype is not None:
+        values = torch.tensor(values, dtype=dtype)
     
-    sz = t.element_size()
-    shape = t.shape
-    params = 1
-
-    for c in shape:
-        params = params * c
-
-    size = params * sz
-
-    return params, size
+    return offsets, values
 
 
-def create_dataset_indexes(dataset, file_name):
+def ragged_rows(offsets):
     
     """
-    Load dataset indexes
+    Returns row index and position in row of every value of ragged batch
     """
     
-    index = load_json( file_name )
-    if index is None:
-        index = list(np.random.permutation( len(dataset) ))
-        save_json(file_name, index, indent=None)
+    lengths = offsets[1:] - offsets[:-1]
+    rows = torch.repeat_interleave(torch.arange(len(lengths)), lengths)
+    pos = torch.arange(int(offsets[-1])) - offsets[rows]
     
-    return index
+    return rows, pos
 
 
-def split_dataset(dataset, k=0.2, indexes=None):
+def batch_one_hot_encoder(num_class):
     
     """
-    Split dataset for train and validation
+    Returns one hot encoder of batch of class indexes.
+    Index -1 is encoded as zeros.
     """
     
-    sz = len(dataset)
-    train_count = round(sz * (1 - k))
-    val_count = sz - train_count
-    
-    if indexes is None:
-        indexes = list(np.random.permutation(sz))
-    
-    from torch.utils.data import Subset
-    return [Subset(dataset, indexes[0 : train_count]), Subset(dataset, indexes[train_count : ])]
+    def f(t):
+        if not isinstance(t, torch.Tensor):
+            t = torch.tensor(t)
+        t = t.to(torch.int64)
+        res = torch.zeros(len(t), num_class)
+        res.scatter_(1, t.clamp(min=0)[:, None], (t >= 0).to(torch.float32)[:, None])
+        return res
     
+    return f
 
 
-def get_default_device():
+def batch_label_encoder(labels):
     
     """
-    Returns default device
+    Returns one hot encoder of batch of labels
     """
     
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    labels = make_index(labels)
+    one_hot = batch_one_hot_encoder(len(labels))
     
-    return device
+    def f(batch):
+        return one_hot([ labels.get(label_name, -1) for label_name in batch ])
+    
+    return f
 
 
-def get_acc_class():
+def batch_bag_of_words_encoder(dictionary_sz):
     
     """
-    Returns class accuracy
+    Returns bag of words encoder of batch of dictionary indexes.
+    Batch is list of indexes lists or tuple of offsets and values.
     """
     
-    def f(batch_predict, batch_y):
+    def f(batch):
         
-        if len(batch_y.shape) == 2:
-            batch_y = torch.argmax(batch_y, dim=1)
+        offsets, values = ragged_batch(batch)
+        rows, _ = ragged_rows(offsets)
         
-        batch_predict = torch.argmax(batch_predict, dim=1)
-        acc = torch.sum( torch.eq(batch_y, batch_predict) ).item()
+        mask = values > 0
+        t = torch.zeros(len(offsets) - 1, dictionary_sz - 1)
+        t[rows[mask], values[mask] - 1] = 1
         
-        return acc
+        return t
     
     return f
 
 
-def get_acc_binary(logits=True, treshold=0.5):
+def batch_dictionary_encoder(dictionary, max_words):
     
     """
-    Returns binary accuracy
+    Returns encoder of batch of texts to words indexes.
+    Batch is list of words lists or tuple of offsets and words.
+    Only first max_words words are encoded, words which do not exist
+    in dictionary are skipped.
     """
     
-    def f(batch_predict, batch_y):
+    def f(batch):
         
-        if logits:
-            batch_predict = torch.sigmoid(batch_predict)
+        offsets, words = ragged_batch(batch, dtype=None)
+        rows, pos = ragged_rows(offsets)
         
-        batch_predict = (batch_predict >= treshold) * 1.0
-        acc = torch.sum( torch.eq(batch_y, batch_predict) ).item()
+        index = torch.tensor([ dictionary.get(word, -1) for word in words ], dtype=torch.int64)
+        mask = (index >= 0) & (pos < max_words)
+        rows = rows[mask]
+        index = index[mask]
         
-        if len(batch_y.shape) == 2:
-            return acc / batch_y.shape[1]
-            
-        return acc
+        # Positions of found words in row
+        lengths = torch.bincount(rows, minlength=len(offsets) - 1)
+        offsets = torch.zeros(len(lengths) + 1, dtype=torch.int64)
+        torch.cumsum(lengths, 0, out=offsets[1:])
+        pos = torch.arange(len(index)) - offsets[rows]
+        
+        t = torch.zeros(len(lengths), max_words, dtype=torch.int64)
+        t[rows, pos] = index
         
+        return t
+    
     return f
 
 
-def get_iou_score(logits=True, treshold=0.5):
+def batch_collate(transform_x=None, transform_y=None):
     
     """
-    Returns IoU
+    Returns collate_fn for dataset of (x, y) items. Batch encoders
+    transform_x and transform_y get list of x and list of y.
+    Without encoder, values are collated by default_collate.
     """
     
-    def f(batch_predict, batch_y):
-        
-        if logits:
-            batch_predict = torch.sigmoid(batch_predict)
-        
-        batch_predict = (batch_predict > treshold).int()
-        batch_y = batch_y.int()
+    def f(batch):
         
-        intersection = torch.sum(batch_predict & batch_y).item()
-        union = torch.sum(batch_predict | batch_y).item()
+        res = {}
+        for name, pos, transform in (("x", 0, transform_x), ("y", 1, transform_y)):
+            
+            items = [ item[pos] for item in batch ]
+            if transform is not None:
+                res[name] = transform(items)
+            else:
+                res[name] = torch.utils.data.default_collate(items)
         
-        iou = intersection / union if union > 0 else 0.0
-        return iou
+        return res
     
     return f
 
 
-def get_f1_score(logits=True, treshold=0.5):
-    
-    """
-    Returns F1 Score
-    """
+def batch_map(f):
     
-    def f(batch_predict, batch_y):
-        
-        if logits:
-            batch_predict = torch.sigmoid(batch_predict)
-        
-        f1_score = 0.0
-        batch_predict = (batch_predict > treshold).int()
-        batch_y = batch_y.int()
-        
-        TP = torch.sum((batch_predict == 1) & (batch_y == 1)).item()
-        FP = torch.sum((batch_predict == 1) & (batch_y == 0)).item()
-        FN = torch.sum((batch_predict == 0) & (batch_y == 1)).item()
+    def transform(batch_x):
         
-        precision = TP / (TP + FP) if TP + FP > 0 else 0.0
-        recall = TP / (TP + FN) if TP + FP > 0 else 0.0
+        if len(batch_x) == 0:
+            return torch.tensor([]).to(batch_x.device)
         
-        if precision + recall > 0:
-            f1_score = 2 * (precision * recall) / (precision + recall)
+        res = torch.stack([ f(batch_x[i]) for i in range(len(batch_x)) ])
         
-        return f1_score
+        # Result is float32 or wider float, like concat with float32 tensor
+        dtype = torch.promote_types(torch.float32, res.dtype)
+        return res.to(batch_x.device, dtype)
     
-    return f
+    return transform
 
 
-def resize_image(image, new_size, contain=True, color=None):
-   
+def batch_to(x, device, non_blocking=False):
+    
     """
-    Resize image
+    Move batch to device. Batch may be tensor or nested dict, list, tuple.
+    Other values are returned as is.
     """
     
-    if isinstance(image, str):
-        image = Image.open(image)
-    
-    if isinstance(image, np.ndarray):
-        image = Image.fromarray(image)
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=non_blocking)
     
-    w1 = image.size[0]
-    h1 = image.size[1]
-    w2 = new_size[0]
-    h2 = new_size[1]
-
-    k1 = w1 / h1
-    k2 = w2 / h2
-    w_new = 0
-    h_new = 0
+    if isinstance(x, dict):
+        return { key: batch_to(x[key], device, non_blocking) for key in x }
     
-    if k1 > k2 and contain or k1 < k2 and not contain:
-        h_new = round(w2 * h1 / w1)
-        w_new = w2
-        
-    else:
-        h_new = h2
-        w_new = round(h2 * w1 / h1)
+    if isinstance(x, list):
+        return [ batch_to(item, device, non_blocking) for item in x ]
     
-    image_new = image.resize( (w_new, h_new) )
-    image_resize = resize_image_canvas(image_new, new_size, color=color)
-    del image_new
+    if isinstance(x, tuple):
+        return tuple( batch_to(item, device, non_blocking) for item in x )
     
-    return image_resize
+    if hasattr(x, "to"):
+        return x.to(device)
     
+    return x
 
-def resize_image_canvas(image, size, color=None):
-   
+
+def batch_detach(x):
+    
     """
-    Resize image canvas
+    Detach batch tensors
     """
     
-    width, height = size
+    if isinstance(x, torch.Tensor):
+        return x.detach()
     
-    if color == None:
-        pixels = image.load()
-        color = pixels[0, 0]
-        del pixels
+    if isinstance(x, dict):
+        return { key: batch_detach(x[key]) for key in x }
     
-    image_new = Image.new(image.mode, (width, height), color = color)
+    if isinstance(x, list):
+        return [ batch_detach(item) for item in x ]
     
-    position = (
-        math.ceil((width - image.size[0]) / 2),
-        math.ceil((height - image.size[1]) / 2),
-    )
+    if isinstance(x, tuple):
+        return tuple( batch_detach(item) for item in x )
     
-    image_new.paste(image, position)
-    return image_new
+    return x
 
 
-def load_image(file_name, convert=None, load_as=""):
+def is_batch_items(x):
     
-    image = Image.open(file_name)
+    """
+    Returns True if list contains per sample values
+    """
     
-    if convert:
-        image = image.convert(convert)
+    for item in x:
+        if isinstance(item, (torch.Tensor, dict, list, tuple)):
+            return False
     
-    if load_as == "numpy":
-        image = np.array(image)
+    return True
+
+
+def batch_slice(x, start, end):
     
-    elif load_as == "torch":
-        image = torch.from_numpy(np.array(image))
+    """
+    Returns batch items from start to end. Tensors are sliced by first axis,
+    list of tensors is sliced item by item, list of other values is sliced as is.
+    """
     
-    return image
-
+    if isinstance(x, torch.Tensor) or isinstance(x, np.ndarray):
+        return x[start:end]
+    
+    if isinstance(x, dict):
+        return { key: batch_slice(x[key], start, end) for key in x }
+    
+    if isinstance(x, list) or isinstance(x, tuple):
+        if is_batch_items(x):
+            return x[start:end]
+        res = [ batch_slice(item, start, end) for item in x ]
+        return tuple(res) if isinstance(x, tuple) else res
+    
+    return x
 
-def draw_images(images, ncols=4, cmap=None, first_channel=False, labels=None):
 
-    import matplotlib.pyplot as plt
+def split_batch(batch, batch_len, size):
     
-    count_images = len(images)
+    """
+    Split batch to chunks of size
+    """
     
-    fig, ax = plt.subplots(
-        (count_images - 1) // ncols + 1, ncols,
-        figsize=(10, 6), sharey=True, sharex=True
-    )
-    fig.subplots_adjust(0, 0, 1, 1)
-    ax = ax.flatten()
+    return [
+        batch_slice(batch, start, min(start + size, batch_len))
+            for start in range(0, batch_len, size)
+    ]
 
-    # Рисуем картинки
-    for i in range(count_images):
-        image = images[i]
-        
-        if isinstance(image, str):
-            image = load_image(image, load_as="torch")
-        
-        if isinstance(image, np.ndarray):
-            pass
-        
-        if isinstance(image, torch.Tensor):
-            if first_channel == True:
-                image = move_rgb_to_end(image)
-        
-        ax[i].imshow(image, cmap)
-        if labels:
-            ax[i].set_xlabel(labels[i], fontsize=8)
 
-    # Скрываем лишние картинки
-    for i in range(count_images, len(ax)):
-        ax[i].set_visible(False)
+def batch_cat(items):
+    
+    """
+    Concat list of batches
+    """
+    
+    first = items[0]
+    
+    if isinstance(first, torch.Tensor):
+        return torch.cat(items)
+    
+    if isinstance(first, dict):
+        return { key: batch_cat([ item[key] for item in items ]) for key in first }
+    
+    if isinstance(first, list) or isinstance(first, tuple):
+        if is_batch_items(first):
+            res = []
+            for item in items:
+                res.extend(item)
+        else:
+            res = [
+                batch_cat([ item[index] for item in items ])
+                    for index in range(len(first))
+            ]
+        return tuple(res) if isinstance(first, tuple) else res
+    
+    return first
+
+
+def batch_record_stream(x, stream):
+    
+    """
+    Mark batch tensors as used by stream
+    """
+    
+    if isinstance(x, torch.Tensor):
+        if x.is_cuda:
+            x.record_stream(stream)
+    
+    elif isinstance(x, dict):
+        for key in x:
+            batch_record_stream(x[key], stream)
+    
+    elif isinstance(x, list) or isinstance(x, tuple):
+        for item in x:
+            batch_record_stream(item, stream)
+
+
+class DevicePrefetcher:
+    
+    """
+    Wraps loader and prepares next batch while current batch is computed.
+    Prepare runs transform and moves batch to device with non_blocking.
+    On cuda next batch is prepared in separate cuda stream,
+    on other devices in background thread.
+    """
+    
+    def __init__(self, loader, device, transform=None, size=2):
+        self.loader = loader
+        self.device = device
+        self.transform = transform
+        self.size = size
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def __iter__(self):
+        if get_device_type(self.device) == "cuda" and torch.cuda.is_available():
+            return self.iter_cuda()
+        return self.iter_thread()
+    
+    def prepare(self, batch):
+        
+        if self.transform is not None:
+            batch = self.transform(batch)
+        
+        return batch_to(batch, self.device, non_blocking=True)
+    
+    def iter_cuda(self):
+        
+        stream = torch.cuda.Stream(self.device)
+        it = iter(self.loader)
+        
+        def load():
+            try:
+                batch = next(it)
+            except StopIteration:
+                return None, False
+            
+            with torch.cuda.stream(stream):
+                batch = self.prepare(batch)
+            
+            return batch, True
+        
+        next_batch, is_next = load()
+        while is_next:
+            
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            
+            batch = next_batch
+            batch_record_stream(batch, current_stream)
+            
+            next_batch, is_next = load()
+            yield batch
+    
+    def iter_thread(self):
+        
+        items = queue.Queue(self.size)
+        stop = threading.Event()
+        grad_enabled = torch.is_grad_enabled()
+        
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def worker():
+            
+            # Grad mode is thread local
+            torch.set_grad_enabled(grad_enabled)
+            
+            try:
+                for batch in self.loader:
+                    if not put( (self.prepare(batch), None) ):
+                        return
+                put( (None, StopIteration()) )
+            
+            except Exception as e:
+                put( (None, e) )
+        
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        
+        try:
+            while True:
+                batch, error = items.get()
+                if isinstance(error, StopIteration):
+                    break
+                if error is not None:
+                    raise error
+                yield batch
+        
+        finally:
+            stop.set()
+            thread.join()
+
+
+def get_device_type(device):
+    
+    """
+    Returns device type, for example 'cuda' or 'cpu'
+    """
+    
+    if isinstance(device, torch.device):
+        return device.type
+    
+    return torch.device(device).type
+
+
+def get_autocast_dtype(precision):
+    
+    """
+    Returns autocast dtype for precision. None means full fp32
+    """
+    
+    if precision is None or precision == "fp32":
+        return None
+    
+    if precision == "bf16":
+        return torch.bfloat16
+    
+    if precision == "fp16":
+        return torch.float16
+    
+    raise ValueError("Unknown precision " + str(precision))
+
+
+def get_autocast(device, precision=None):
+    
+    """
+    Returns autocast context for device and precision
+    """
+    
+    dtype = get_autocast_dtype(precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+    
+    return torch.autocast(device_type=get_device_type(device), dtype=dtype)
+
+
+def create_grad_scaler(device, precision=None):
+    
+    """
+    Returns grad scaler for precision. Only fp16 needs loss scaling
+    """
+    
+    if get_autocast_dtype(precision) != torch.float16:
+        return None
+    
+    return torch.amp.GradScaler(get_device_type(device))
+
+
+def is_oom_error(e):
+    
+    """
+    Returns True if exception is out of memory error
+    """
+    
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+class MemoryPolicy:
+    
+    """
+    Memory management policy for train and predict loops:
+    never - do not clear cache
+    per_iter - clear cache after every batch
+    per_epoch - clear cache at the end of the epoch
+    on_oom - clear cache only after out of memory error
+    
+    If retry_oom is True, the batch is retried once after out of memory error.
+    """
+    
+    def __init__(self, policy="per_epoch", retry_oom=None, collect=False):
+        
+        if not (policy in ["never", "per_iter", "per_epoch", "on_oom"]):
+            raise ValueError("Unknown memory policy " + str(policy))
+        
+        if retry_oom is None:
+            retry_oom = policy != "never"
+        
+        self.policy = policy
+        self.retry_oom = retry_oom
+        self.collect = collect
+        self.oom_count = 0
+    
+    def clear_cache(self):
+        
+        if self.collect:
+            gc.collect()
+        
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
+    def on_iter(self):
+        if self.policy == "per_iter":
+            self.clear_cache()
+    
+    def on_epoch(self):
+        if self.policy == "per_iter" or self.policy == "per_epoch":
+            self.clear_cache()
+    
+    def run(self, f, *args, on_oom=None, **kwargs):
+        
+        """
+        Run batch function, retry it once after out of memory error
+        """
+        
+        if not self.retry_oom:
+            return f(*args, **kwargs)
+        
+        try:
+            return f(*args, **kwargs)
+        
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+        
+        # Free memory outside except block, so traceback does not hold tensors
+        self.oom_count += 1
+        if on_oom is not None:
+            on_oom()
+        
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        
+        return f(*args, **kwargs)
+
+
+def get_memory_policy(memory_policy=None):
+    
+    """
+    Returns memory policy object from name
+    """
+    
+    if memory_policy is None:
+        return MemoryPolicy()
+    
+    if isinstance(memory_policy, MemoryPolicy):
+        return memory_policy
+    
+    return MemoryPolicy(memory_policy)
+
+
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def get_rank():
+    return torch.distributed.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return torch.distributed.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None):
+    
+    """
+    Init process group from environment variables, if it is not initialized.
+    Backend is nccl if cuda is available, otherwise gloo.
+    """
+    
+    if not is_distributed():
+        if backend is None:
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        torch.distributed.init_process_group(backend)
+    
+    return get_world_size()
+
+
+def get_reduce_device():
+    if torch.distributed.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def all_reduce_values(values):
+    
+    """
+    Sum list of numbers across processes with one all_reduce
+    """
+    
+    if len(values) == 0:
+        return []
+    
+    t = torch.tensor(values, dtype=torch.float64, device=get_reduce_device())
+    torch.distributed.all_reduce(t)
+    
+    return t.tolist()
+
+
+def all_reduce_grads(parameters):
+    
+    """
+    Average gradients across processes
+    """
+    
+    grads = [ p.grad for p in parameters if p.grad is not None ]
+    if len(grads) == 0:
+        return
+    
+    world_size = get_world_size()
+    for grad in grads:
+        torch.distributed.all_reduce(grad)
+        grad.div_(world_size)
+
+
+def tensor_size(t):
+
+    """
+    Returns tensor size
+    """
+    
+    if not isinstance(t, torch.Tensor):
+        return 0, 0
+    
+    sz = t.element_size()
+    shape = t.shape
+    params = 1
+
+    for c in shape:
+        params = params * c
+
+    size = params * sz
+
+    return params, size
+
+
+def create_dataset_indexes(dataset, file_name):
+    
+    """
+    Load dataset indexes
+    """
+    
+    index = load_json( file_name )
+    if index is None:
+        index = list(np.random.permutation( len(dataset) ))
+        save_json(file_name, index, indent=None)
+    
+    return index
+
+
+def split_dataset(dataset, k=0.2, indexes=None):
+    
+    """
+    Split dataset for train and validation
+    """
+    
+    sz = len(dataset)
+    train_count = round(sz * (1 - k))
+    val_count = sz - train_count
+    
+    if indexes is None:
+        indexes = list(np.random.permutation(sz))
+    
+    from torch.utils.data import Subset
+    return [Subset(dataset, indexes[0 : train_count]), Subset(dataset, indexes[train_count : ])]
+    
+
+
+def get_default_device():
+    
+    """
+    Returns default device
+    """
+    
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    
+    return device
+
+
+def get_acc_class(tensor=False):
+    
+    """
+    Returns class accuracy. If tensor is True, accuracy is returned
+    as tensor on device without sync.
+    """
+    
+    def f(batch_predict, batch_y):
+        
+        if len(batch_y.shape) == 2:
+            batch_y = torch.argmax(batch_y, dim=1)
+        
+        batch_predict = torch.argmax(batch_predict, dim=1)
+        acc = torch.sum( torch.eq(batch_y, batch_predict) )
+        
+        return acc if tensor else acc.item()
+    
+    return f
+
+
+def get_acc_binary(logits=True, treshold=0.5, tensor=False):
+    
+    """
+    Returns binary accuracy. If tensor is True, accuracy is returned
+    as tensor on device without sync.
+    """
+    
+    def f(batch_predict, batch_y):
+        
+        if logits:
+            batch_predict = torch.sigmoid(batch_predict)
+        
+        batch_predict = (batch_predict >= treshold) * 1.0
+        acc = torch.sum( torch.eq(batch_y, batch_predict) )
+        
+        if len(batch_y.shape) == 2:
+            acc = acc / batch_y.shape[1]
+        
+        return acc if tensor else acc.item()
+    
+    return f
+
+
+def get_iou_stats(logits=True, treshold=0.5):
+    
+    """
+    Returns IoU intersection and union
+    """
+    
+    def f(batch_predict, batch_y):
+        
+        if logits:
+            batch_predict = torch.sigmoid(batch_predict)
+        
+        batch_predict = (batch_predict > treshold).int()
+        batch_y = batch_y.int()
+        
+        return {
+            "intersection": torch.sum(batch_predict & batch_y),
+            "union": torch.sum(batch_predict | batch_y),
+        }
+    
+    return f
+
+
+def get_iou_from_stats(stats):
+    
+    """
+    Returns IoU from intersection and union sums
+    """
+    
+    union = float(stats["union"])
+    return float(stats["intersection"]) / union if union > 0 else 0.0
+
+
+def get_iou_score(logits=True, treshold=0.5, tensor=False):
+    
+    """
+    Returns IoU. If tensor is True, IoU is returned as tensor on device
+    without sync.
+    """
+    
+    get_stats = get_iou_stats(logits, treshold)
+    
+    def f(batch_predict, batch_y):
+        
+        stats = get_stats(batch_predict, batch_y)
+        
+        # Intersection is zero if union is zero
+        iou = stats["intersection"] / stats["union"].clamp(min=1)
+        return iou if tensor else iou.item()
+    
+    return f
+
+
+def get_f1_stats(logits=True, treshold=0.5):
+    
+    """
+    Returns F1 Score TP, FP and FN
+    """
+    
+    def f(batch_predict, batch_y):
+        
+        if logits:
+            batch_predict = torch.sigmoid(batch_predict)
+        
+        batch_predict = (batch_predict > treshold).int()
+        batch_y = batch_y.int()
+        
+        return {
+            "TP": torch.sum((batch_predict == 1) & (batch_y == 1)),
+            "FP": torch.sum((batch_predict == 1) & (batch_y == 0)),
+            "FN": torch.sum((batch_predict == 0) & (batch_y == 1)),
+        }
+    
+    return f
+
+
+def get_f1_from_stats(stats):
+    
+    """
+    Returns F1 Score from TP, FP and FN sums
+    """
+    
+    TP = float(stats["TP"])
+    FP = float(stats["FP"])
+    FN = float(stats["FN"])
+    
+    f1_score = 0.0
+    precision = TP / (TP + FP) if TP + FP > 0 else 0.0
+    recall = TP / (TP + FN) if TP + FN > 0 else 0.0
+    
+    if precision + recall > 0:
+        f1_score = 2 * (precision * recall) / (precision + recall)
+    
+    return f1_score
+
+
+def get_f1_score(logits=True, treshold=0.5, tensor=False):
+    
+    """
+    Returns F1 Score. If tensor is True, F1 Score is returned as tensor
+    on device without sync.
+    """
+    
+    get_stats = get_f1_stats(logits, treshold)
+    
+    def f(batch_predict, batch_y):
+        
+        stats = get_stats(batch_predict, batch_y)
+        TP = stats["TP"]
+        
+        # Same as 2 * precision * recall / (precision + recall)
+        f1_score = 2 * TP / (2 * TP + stats["FP"] + stats["FN"]).clamp(min=1)
+        return f1_score if tensor else f1_score.item()
+    
+    return f
+
+
+class MetricAccumulator:
+    
+    """
+    Keeps running sums of metrics on device.
+    Values are read back to host only in get_values.
+    """
+    
+    def __init__(self):
+        self.sums = {}
+    
+    def reset(self):
+        self.sums = {}
+    
+    def add(self, name, value):
+        
+        """
+        Add value to sum. Dict values are added as name_key
+        """
+        
+        if isinstance(value, dict):
+            for key in value:
+                self.add(name + "_" + key, value[key])
+            return
+        
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            if value.is_floating_point():
+                value = value.to(torch.float32)
+        
+        if name in self.sums:
+            self.sums[name] = self.sums[name] + value
+        else:
+            self.sums[name] = value
+    
+    def get_values(self):
+        
+        """
+        Returns sums as numbers. Tensors with the same device and dtype
+        are read back with one sync
+        """
+        
+        res = {}
+        groups = {}
+        for name in self.sums:
+            value = self.sums[name]
+            if isinstance(value, torch.Tensor):
+                key = (value.device, value.dtype)
+                if not (key in groups):
+                    groups[key] = []
+                groups[key].append(name)
+            else:
+                res[name] = value
+        
+        for key in groups:
+            names = groups[key]
+            values = torch.stack([ self.sums[name].reshape(()) for name in names ])
+            values = values.tolist()
+            for index, name in enumerate(names):
+                res[name] = values[index]
+        
+        return res
+    
+    def all_reduce(self):
+        
+        """
+        Sum metrics across processes. Sums become numbers.
+        """
+        
+        values = self.get_values()
+        names = sorted(values.keys())
+        values = all_reduce_values([ values[name] for name in names ])
+        self.sums = dict(zip(names, values))
+
+
+def resize_image(image, new_size, contain=True, color=None):
+   
+    """
+    Resize image
+    """
+    
+    if isinstance(image, str):
+        image = Image.open(image)
+    
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    
+    w1 = image.size[0]
+    h1 = image.size[1]
+    w2 = new_size[0]
+    h2 = new_size[1]
+
+    k1 = w1 / h1
+    k2 = w2 / h2
+    w_new = 0
+    h_new = 0
+    
+    if k1 > k2 and contain or k1 < k2 and not contain:
+        h_new = round(w2 * h1 / w1)
+        w_new = w2
+        
+    else:
+        h_new = h2
+        w_new = round(h2 * w1 / h1)
+    
+    image_new = image.resize( (w_new, h_new) )
+    image_resize = resize_image_canvas(image_new, new_size, color=color)
+    del image_new
+    
+    return image_resize
+    
+
+def resize_image_canvas(image, size, color=None):
+   
+    """
+    Resize image canvas
+    """
+    
+    width, height = size
+    
+    if color == None:
+        color = image.getpixel((0, 0))
+    
+    image_new = Image.new(image.mode, (width, height), color = color)
+    
+    position = (
+        math.ceil((width - image.size[0]) / 2),
+        math.ceil((height - image.size[1]) / 2),
+    )
+    
+    image_new.paste(image, position)
+    return image_new
+
+
+thread_pools = {}
+
+
+def get_thread_pool(num_workers=None):
+    
+    """
+    Returns shared thread pool. Pool is created once in every process.
+    """
+    
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    
+    key = (os.getpid(), num_workers)
+    if not (key in thread_pools):
+        thread_pools[key] = ThreadPoolExecutor(num_workers)
+    
+    return thread_pools[key]
+
+
+def thread_map(f, items, num_workers=None):
+    
+    """
+    Map items in thread pool. Returns list.
+    """
+    
+    if num_workers == 0 or len(items) <= 1:
+        return [ f(item) for item in items ]
+    
+    return list(get_thread_pool(num_workers).map(f, items))
+
+
+def get_resize_size(size, new_size, contain=True):
+    
+    """
+    Returns size of image in resize_image
+    """
+    
+    w1, h1 = size
+    w2, h2 = new_size
+    
+    if w1 / h1 > w2 / h2 and contain or w1 / h1 < w2 / h2 and not contain:
+        return w2, round(w2 * h1 / w1)
+    
+    return round(h2 * w1 / h1), h2
+
+
+def read_image_to(image, out, size=None, mode=None, contain=True, color=None, draft=True):
+    
+    """
+    Read image to numpy array out of shape (height, width, channels).
+    Image is resized and placed in center like resize_image.
+    JPEG image is decoded at reduced scale with draft, if it is possible.
+    """
+    
+    if isinstance(image, str):
+        image = Image.open(image)
+    
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    
+    if size is None:
+        size = image.size
+    
+    new_size = get_resize_size(image.size, size, contain)
+    
+    if draft and image.format == "JPEG":
+        image.draft(mode if mode is not None else image.mode, new_size)
+    
+    if mode is not None and image.mode != mode:
+        image = image.convert(mode)
+    
+    if image.size != new_size:
+        image = image.resize(new_size)
+    
+    data = np.asarray(image)
+    if data.ndim == 2 and out.ndim == 3:
+        data = data[:, :, None]
+    
+    # Canvas color
+    if color is None:
+        out[...] = data[0, 0]
+    elif isinstance(color, str):
+        out[...] = ImageColor.getcolor(color, image.mode)
+    else:
+        out[...] = color
+    
+    # Copy to center, image may be bigger than canvas
+    width, height = size
+    x = math.ceil((width - new_size[0]) / 2)
+    y = math.ceil((height - new_size[1]) / 2)
+    out[max(y, 0):y + new_size[1], max(x, 0):x + new_size[0]] = \
+        data[max(-y, 0):height - y, max(-x, 0):width - x]
+    
+    return out
+
+
+def read_images(images, size=None, mode=None, contain=True, color=None,
+    draft=True, num_workers=None, out=None
+):
+    
+    """
+    Read and resize batch of images in thread pool to uint8 tensor
+    of shape (batch, height, width, channels). Images are files, PIL
+    images or numpy arrays. If size is None, images must have same size.
+    """
+    
+    if len(images) == 0:
+        return torch.tensor([], dtype=torch.uint8)
+    
+    if out is None:
+        
+        # Shape from the first image
+        first = images[0]
+        if isinstance(first, str):
+            first = Image.open(first)
+        if isinstance(first, np.ndarray):
+            first = Image.fromarray(first)
+        
+        width, height = size if size is not None else first.size
+        channels = Image.getmodebands(mode if mode is not None else first.mode)
+        shape = (len(images), height, width)
+        if channels > 1:
+            shape = shape + (channels,)
+        
+        out = torch.empty(shape, dtype=torch.uint8)
+    
+    res = out.numpy()
+    
+    def read(index):
+        read_image_to(images[index], res[index], size, mode, contain, color, draft)
+    
+    thread_map(read, range(len(images)), num_workers)
+    
+    return out
+
+
+class ImageCache:
+    
+    """
+    Cache of decoded and resized images. Key is path, mtime, file size,
+    mode, target size, contain, color and draft.
+    
+    Images are stored in memory LRU up to memory_size bytes and max_count
+    images. If disk_path is set, evicted images are saved to disk as npy
+    files, which are read as memory map, so DataLoader workers share disk
+    cache. Memory map does not count to memory_size. Returned images are
+    read only, copy image before change. Hit counters are kept in shared
+    memory and include DataLoader workers, memory count and size are
+    of current process.
+    """
+    
+    # Rows of counters for DataLoader workers
+    counters_workers = 64
+    
+    def __init__(self, memory_size=256 << 20, disk_path=None, max_count=16384):
+        self.memory_size = memory_size
+        self.max_count = max_count
+        self.disk_path = disk_path
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        
+        # Hits, disk hits and misses. Row 0 is main process, other rows are
+        # workers, so each row is changed by one process
+        self.counters = torch.zeros((self.counters_workers + 1, 3),
+            dtype=torch.int64).share_memory_()
+        
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["items"] = OrderedDict()
+        state["size"] = 0
+        state["lock"] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+    
+    def get_key(self, path, size=None, mode=None, contain=True, color=None, draft=True):
+        
+        """
+        Returns cache key of image
+        """
+        
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+            mode, size and tuple(size), contain, color, draft)
+        
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    
+    def get_disk_path(self, key):
+        return os.path.join(self.disk_path, key[:2], key + ".npy")
+    
+    def count(self, index):
+        
+        """
+        Increment counter of current process
+        """
+        
+        info = torch.utils.data.get_worker_info()
+        row = 0 if info is None else 1 + info.id % self.counters_workers
+        self.counters[row, index] += 1
+    
+    def get_memory_size(self, value):
+        return 0 if isinstance(value, np.memmap) else value.nbytes
+    
+    def add(self, key, value):
+        
+        """
+        Add image to memory cache. Evicted images are saved to disk.
+        """
+        
+        evicted = []
+        with self.lock:
+            
+            if key in self.items:
+                return
+            
+            # Cached image is shared between readers
+            value.setflags(write=False)
+            
+            self.items[key] = value
+            self.size += self.get_memory_size(value)
+            
+            while (self.size > self.memory_size or len(self.items) > self.max_count) \
+                and len(self.items) > 1:
+                item_key, item = self.items.popitem(last=False)
+                self.size -= self.get_memory_size(item)
+                evicted.append((item_key, item))
+        
+        for item_key, item in evicted:
+            self.save(item_key, item)
+    
+    def save(self, key, value):
+        
+        """
+        Save image to disk cache
+        """
+        
+        if self.disk_path is None or isinstance(value, np.memmap):
+            return
+        
+        file_name = self.get_disk_path(key)
+        if os.path.exists(file_name):
+            return
+        
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        tmp_file = file_name + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        
+        try:
+            with open(tmp_file, "wb") as file:
+                np.save(file, value)
+            os.replace(tmp_file, file_name)
+        
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+    
+    def get(self, key):
+        
+        """
+        Returns image from memory or disk, or None
+        """
+        
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+                self.count(0)
+                return value
+        
+        if self.disk_path is not None:
+            file_name = self.get_disk_path(key)
+            if os.path.exists(file_name):
+                value = np.load(file_name, mmap_mode="r")
+                with self.lock:
+                    self.count(1)
+                self.add(key, value)
+                return value
+        
+        with self.lock:
+            self.count(2)
+        
+        return None
+    
+    def read(self, path, size=None, mode=None, contain=True, color=None, draft=True):
+        
+        """
+        Returns uint8 array of image like read_images
+        """
+        
+        key = self.get_key(path, size, mode, contain, color, draft)
+        value = self.get(key)
+        
+        if value is None:
+            value = read_images([path], size, mode=mode, contain=contain, color=color,
+                draft=draft, num_workers=0)[0].numpy()
+            self.add(key, value)
+        
+        return value
+    
+    def read_images(self, paths, size=None, mode=None, contain=True, color=None,
+        draft=True, num_workers=None
+    ):
+        
+        """
+        Returns uint8 batch tensor of images. Images are read in thread pool.
+        """
+        
+        items = thread_map(
+            lambda path: self.read(path, size, mode, contain, color, draft),
+            paths, num_workers
+        )
+        
+        return images_to_batch(items)
+    
+    def stats(self):
+        
+        """
+        Returns cache counters
+        """
+        
+        hits, disk_hits, misses = self.counters.sum(0).tolist()
+        total = hits + disk_hits + misses
+        
+        return {
+            "hits": hits,
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "hit_rate": (hits + disk_hits) / total if total > 0 else 0,
+            "memory_count": len(self.items),
+            "memory_size": self.size,
+        }
+    
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+def images_to_batch(images, dtype=None, out=None):
+    
+    """
+    Convert list of PIL images or numpy arrays to batch tensor.
+    Images are copied once to contiguous uint8 tensor, which may be
+    preallocated as out. Numpy batch is converted without copy.
+    """
+    
+    if isinstance(images, np.ndarray):
+        res = torch.from_numpy(images)
+        return res.to(dtype) if dtype is not None else res
+    
+    if isinstance(images, torch.Tensor):
+        return images.to(dtype) if dtype is not None else images
+    
+    if len(images) == 0:
+        return torch.tensor([], dtype=dtype if dtype is not None else torch.uint8)
+    
+    first = np.asarray(images[0])
+    if out is None:
+        out = torch.empty((len(images),) + first.shape,
+            dtype=torch.from_numpy(np.empty(0, dtype=first.dtype)).dtype)
+    
+    res = out.numpy()
+    res[0] = first
+    for index in range(1, len(images)):
+        res[index] = np.asarray(images[index])
+    
+    return out.to(dtype) if dtype is not None else out
+
+
+def benchmark_batch(batch_sizes=(8, 32, 128, 512, 1024, 4096), image_size=(64, 64),
+    max_cat_size=1024
+):
+    
+    """
+    Compare time in ms of torch.cat accumulation with batch_map, TensorBuffer
+    and images_to_batch for batch sizes. torch.cat is measured only
+    for batch size up to max_cat_size.
+    """
+    
+    def measure(f, batch_size=0):
+        if batch_size > max_cat_size:
+            return float("nan")
+        time_start = time.time()
+        f()
+        return (time.time() - time_start) * 1000
+    
+    def cat_loop(items):
+        res = torch.tensor([])
+        for item in items:
+            res = torch.cat( (res, item[None, :]) )
+        return res
+    
+    def buffer_loop(items):
+        res = TensorBuffer()
+        for item in items:
+            res.append(item)
+        return res.tensor()
+    
+    print("{:>10} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}".format(
+        "Batch", "cat map", "batch_map", "cat append", "buffer", "cat image", "to_batch"
+    ))
+    
+    f = batch_map(lambda x: x * 2)
+    for batch_size in batch_sizes:
+        
+        x = torch.rand(batch_size, 256)
+        images = [
+            Image.fromarray(np.random.randint(0, 255, image_size + (3,), dtype=np.uint8))
+                for i in range(batch_size)
+        ]
+        
+        print("{:>10} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+            batch_size,
+            measure(lambda: cat_loop([ item * 2 for item in x ]), batch_size),
+            measure(lambda: f(x)),
+            measure(lambda: cat_loop(x), batch_size),
+            measure(lambda: buffer_loop(x)),
+            measure(lambda: cat_loop([ torch.from_numpy(np.array(image)) for image in images ]),
+                batch_size),
+            measure(lambda: images_to_batch(images)),
+        ))
+
+
+def load_image(file_name, convert=None, load_as=""):
+    
+    image = Image.open(file_name)
+    
+    if convert:
+        image = image.convert(convert)
+    
+    if load_as == "numpy":
+        image = np.array(image)
+    
+    elif load_as == "torch":
+        image = torch.from_numpy(np.array(image))
+    
+    return image
+
+
+def draw_images(images, ncols=4, cmap=None, first_channel=False, labels=None):
+
+    import matplotlib.pyplot as plt
+    
+    count_images = len(images)
+    
+    fig, ax = plt.subplots(
+        (count_images - 1) // ncols + 1, ncols,
+        figsize=(10, 6), sharey=True, sharex=True
+    )
+    fig.subplots_adjust(0, 0, 1, 1)
+    ax = ax.flatten()
+
+    # Рисуем картинки
+    for i in range(count_images):
+        image = images[i]
+        
+        if isinstance(image, str):
+            image = load_image(image, load_as="torch")
+        
+        if isinstance(image, np.ndarray):
+            pass
+        
+        if isinstance(image, torch.Tensor):
+            if first_channel == True:
+                image = move_rgb_to_end(image)
+        
+        ax[i].imshow(image, cmap)
+        if labels:
+            ax[i].set_xlabel(labels[i], fontsize=8)
+
+    # Скрываем лишние картинки
+    for i in range(count_images, len(ax)):
+        ax[i].set_visible(False)
     
     plt.show()
 
@@ -678,6 +1987,35 @@ def load_model(model, model_name, file_name, repository_path="model"):
     load_model_from_file(model, file_path)
     
 
+def get_compiled_module(module):
+    
+    """
+    Returns original module and compiled module, if module is compiled
+    by torch.compile
+    """
+    
+    orig_module = getattr(module, "_orig_mod", None)
+    if isinstance(orig_module, nn.Module):
+        return orig_module, module
+    
+    return module, None
+
+
+def remove_state_dict_prefix(state_dict, prefix="_orig_mod."):
+    
+    """
+    Remove compiled module prefix from state dict keys
+    """
+    
+    if not any( key.startswith(prefix) for key in state_dict.keys() ):
+        return state_dict
+    
+    return {
+        (key[len(prefix):] if key.startswith(prefix) else key): value
+            for key, value in state_dict.items()
+    }
+
+
 def load_model_from_file(model, file_path):
         
     """
@@ -689,12 +2027,17 @@ def load_model_from_file(model, file_path):
     
     if "epoch" in save_metrics:
         if isinstance(model, nn.Module):
-            state_dict = save_metrics["module"]
+            state_dict = remove_state_dict_prefix(save_metrics["module"])
+    
+    elif isinstance(model, nn.Module):
+        state_dict = remove_state_dict_prefix(state_dict)
     
     model.load_state_dict(state_dict, strict=False)
 
 
-def summary(module, x, model_name=None, device=None, batch_size=2, collate_fn=None, ignore=None):
+def summary(module, x, model_name=None, device=None, batch_size=2, collate_fn=None,
+    ignore=None, loader_params=None
+):
         
     """
     Show model summary
@@ -758,16 +2101,20 @@ def summary(module, x, model_name=None, device=None, batch_size=2, collate_fn=No
     # Get batch from Dataset
     batch = None
     if isinstance(x, torch.utils.data.Dataset):
-        loader = torch.utils.data.DataLoader(
+        
+        if loader_params is None:
+            loader_params = {}
+        
+        loader = create_loader(
             x,
             batch_size=batch_size,
             collate_fn=collate_fn,
-            drop_last=False,
-            shuffle=False
+            **loader_params
         )
-        it = loader._get_iterator()
+        it = iter(loader)
         
         batch = next(it)
+        del it
         
         if hasattr(module, "batch_transform"):
             batch = module.batch_transform(batch, device)
@@ -891,16 +2238,242 @@ def summary(module, x, model_name=None, device=None, batch_size=2, collate_fn=No
     print( "=" * width )
 
 
-def compile(module):
+def find_batch_size(model, dataset, mode="train", collate_fn=None,
+    min_batch_size=2, max_batch_size=4096, repeat=3, precision=None,
+    loader_params=None
+):
+    
+    """
+    Find the largest batch size, which runs forward and backward (mode train)
+    or forward only (mode predict) without out of memory error.
+    Batch size is doubled until error, then binary search is used.
+    Shows samples per second for every probed batch size.
+    Gradients and buffers of module are restored after search.
+    """
+    
+    if loader_params is None:
+        loader_params = {}
+    
+    if precision is None:
+        precision = model.precision
+    
+    device = model.device
+    module = model.module
+    forward_module = model.get_forward_module()
+    loss_fn = model.loss
+    batch_transform = getattr(module, "batch_transform", None)
+    step_forward = getattr(module, "step_forward", None)
+    step_loss = getattr(module, "step_loss", None)
+    is_train = mode == "train"
+    
+    if isinstance(loss_fn, nn.Module):
+        loss_fn = loss_fn.to(device)
+    
+    # Train forward changes batch norm buffers
+    buffers = [ item.detach().clone() for item in module.buffers() ]
+    is_training = module.training
+    
+    # Probe does not accumulate to gradients of caller
+    grads = [ item.grad for item in module.parameters() ]
+    module.zero_grad(set_to_none=True)
+    
+    def synchronize():
+        if get_device_type(device) == "cuda":
+            torch.cuda.synchronize(device)
+    
+    def get_batch(batch_size):
+        loader = create_loader(
+            dataset,
+            batch_size=batch_size,
+            collate_fn=collate_fn,
+            **loader_params
+        )
+        batch = next(iter(loader))
+        del loader
+        if batch_transform:
+            batch = batch_transform(batch, device)
+        return batch_to(batch, device)
+    
+    def step(batch):
+        
+        with torch.set_grad_enabled(is_train), get_autocast(device, precision):
+            
+            if step_forward is not None:
+                loss, _ = step_forward(batch, params={"model": model, "iter": {}})
+            
+            else:
+                y_pred = forward_module(batch["x"])
+                loss = None
+                if is_train:
+                    if step_loss is not None:
+                        loss = step_loss(y_pred, batch["y"], loss_fn=loss_fn)
+                    else:
+                        loss = loss_fn(y_pred, batch["y"])
+                del y_pred
+        
+        if is_train:
+            loss.backward()
+            module.zero_grad(set_to_none=True)
+        
+        del loss
+    
+    def probe(batch_size):
+        
+        try:
+            batch = get_batch(batch_size)
+            
+            # Warmup
+            step(batch)
+            synchronize()
+            
+            time_start = time.time()
+            for i in range(repeat):
+                step(batch)
+            synchronize()
+            
+            t = time.time() - time_start
+            return True, batch_size * repeat / t if t > 0 else 0
+        
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+        
+        module.zero_grad(set_to_none=True)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        
+        return False, 0
+    
+    results = []
+    
+    def check(batch_size):
+        is_ok, speed = probe(batch_size)
+        results.append([batch_size, "ok" if is_ok else "oom", round(speed, 1)])
+        print ("\rBatch size " + str(batch_size) + ": " + results[-1][1], end="")
+        return is_ok
+    
+    max_batch_size = min(max_batch_size, len(dataset))
+    good = 0
+    bad = None
+    batch_size = min(min_batch_size, max_batch_size)
+    
+    if is_train:
+        module.train()
+    else:
+        module.eval()
+    
+    try:
+        
+        # Double batch size until out of memory
+        while True:
+            if not check(batch_size):
+                bad = batch_size
+                break
+            good = batch_size
+            if batch_size >= max_batch_size:
+                break
+            batch_size = min(batch_size * 2, max_batch_size)
+        
+        # Binary search
+        if bad is not None and good > 0:
+            while bad - good > 1:
+                batch_size = (good + bad) // 2
+                if check(batch_size):
+                    good = batch_size
+                else:
+                    bad = batch_size
+    
+    finally:
+        
+        with torch.no_grad():
+            for item, value in zip(module.buffers(), buffers):
+                item.copy_(value)
+        
+        module.train(is_training)
+        for item, grad in zip(module.parameters(), grads):
+            item.grad = grad
+    
+    # Print info
+    results.sort(key=lambda item: item[0])
+    print ("\r" + "=" * 36)
+    print ( "{:<12} {:>8} {:>14}".format("Batch size", "Status", "Samples/s") )
+    print ("-" * 36)
+    for item in results:
+        print ( "{:<12} {:>8} {:>14}".format(*item) )
+    print ("-" * 36)
+    print ( "Mode: " + str(mode) + ", device: " + str(device) )
+    print ( "Max batch size: " + str(good) )
+    print ("=" * 36)
+    
+    return good
+
+
+def compile(module, backend=None, mode=None, **kwargs):
+    
+    """
+    Returns Model for module. If backend or mode is set,
+    module forward is compiled by torch.compile
+    """
+    
     from .Model import Model
-    return Model(module)
+    
+    model = Model(module)
+    
+    if backend is not None or mode is not None or len(kwargs) > 0:
+        if backend is None:
+            backend = "inductor"
+        model.set_compile(backend=backend, mode=mode, **kwargs)
+    
+    return model
+
+
+def set_loader_epoch(loader, epoch):
+    
+    """
+    Set epoch of loader sampler and iterable dataset. Persistent workers
+    have own copy of dataset, so iterable dataset must keep epoch in shared
+    memory, like CSVIterableDataset with shared_epoch, otherwise workers
+    do not see new epoch.
+    """
+    
+    sampler = getattr(loader, "sampler", None)
+    if hasattr(sampler, "set_epoch"):
+        sampler.set_epoch(epoch)
+    
+    dataset = getattr(loader, "dataset", None)
+    if isinstance(dataset, torch.utils.data.IterableDataset) and \
+        hasattr(dataset, "set_epoch"):
+        
+        dataset.set_epoch(epoch)
+        
+        if getattr(loader, "persistent_workers", False) and \
+            not hasattr(dataset, "shared_epoch"):
+            warnings.warn("Epoch of " + dataset.__class__.__name__ +
+                " is not seen by persistent workers, create loader with"
+                " persistent_workers=False")
+
+
+def get_rank_count(dataset, world_size):
+    
+    """
+    Returns count of items of dataset for one rank. Iterable dataset
+    returns count of own rank, other datasets are split by sampler.
+    """
+    
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        return len(dataset)
+    
+    return math.ceil(len(dataset) / world_size)
 
 
 def fit(
     model, train_dataset=None, val_dataset=None,
     batch_size=64, epochs=10, collate_fn=None,
     callbacks=None, do_train=True, do_val=True,
-    **params
+    precision=None, memory_policy=None, sync_steps=16, loader_params=None,
+    prefetch=False, accumulate_steps=1, micro_batch_size=None,
+    distributed=False, **params
 ):
     if callbacks is None:
         callbacks = []
@@ -918,6 +2491,45 @@ def fit(
     params["collate_fn"] = collate_fn
     params["iter"] = {}
     
+    if loader_params is None:
+        loader_params = {}
+    
+    # Distributed data parallel
+    world_size = 1
+    if distributed:
+        world_size = init_distributed()
+        loader_params = {**loader_params, "distributed": True}
+        
+        if get_device_type(model.device) == "cuda":
+            local_rank = int(os.environ.get("LOCAL_RANK", get_rank() % torch.cuda.device_count()))
+            torch.cuda.set_device(local_rank)
+            model.to(torch.device("cuda", local_rank))
+    
+    params["distributed"] = distributed
+    params["rank"] = get_rank()
+    params["world_size"] = world_size
+    params["loader_params"] = loader_params
+    
+    if precision is None:
+        precision = model.precision
+    
+    params["precision"] = precision
+    
+    memory_policy = get_memory_policy(memory_policy)
+    params["memory_policy"] = memory_policy
+    
+    metrics = MetricAccumulator()
+    params["metrics"] = metrics
+    params["sync_steps"] = sync_steps
+    params["accumulate_steps"] = accumulate_steps
+    params["micro_batch_size"] = micro_batch_size
+    
+    accumulate = {
+        "index": 0,
+        "size": micro_batch_size if micro_batch_size != "auto" else None,
+        "state": None,
+    }
+    
     device = model.device
     model_name = model.get_model_name()
     
@@ -926,143 +2538,356 @@ def fit(
     
     # Train loader
     if not "train_loader" in params:
-        train_loader = DataLoader(
+        train_loader = create_loader(
             train_dataset,
             batch_size=batch_size,
             collate_fn=collate_fn,
-            drop_last=False,
-            shuffle=True
+            shuffle=True,
+            **loader_params
         )
         params["train_loader"] = train_loader
     
-    # Val loader
-    val_loader = None
-    if val_dataset:
-        if not "val_loader" in params:
-            val_loader = DataLoader(
-                val_dataset,
-                batch_size=batch_size,
-                collate_fn=collate_fn,
-                drop_last=False,
-                shuffle=False
-            )
-            params["val_loader"] = val_loader
+    # Val loader
+    val_loader = None
+    if val_dataset:
+        if not "val_loader" in params:
+            val_loader = create_loader(
+                val_dataset,
+                batch_size=batch_size,
+                collate_fn=collate_fn,
+                **loader_params
+            )
+            params["val_loader"] = val_loader
+    
+    device = model.device
+    loss_fn = model.loss
+    min_lr = model.min_lr
+    module = model.module
+    forward_module = model.get_forward_module()
+    ddp_module = None
+    model.load_train_state()
+    optimizer = model.optimizer
+    scheduler = model.scheduler
+    scaler = model.get_scaler(precision)
+    
+    batch_transform = getattr(module, "batch_transform", None)
+    step_forward = getattr(module, "step_forward", None)
+    step_loss = getattr(module, "step_loss", None)
+    step_scheduler = getattr(module, "step_scheduler", None)
+    get_batch_size = getattr(module, "get_batch_size", None)
+    split_batch_fn = getattr(module, "split_batch", None)
+    
+    if isinstance(loss_fn, nn.Module):
+        loss_fn = loss_fn.to(model.device)
+    
+    if distributed:
+        device_ids = [device] if get_device_type(device) == "cuda" else None
+        ddp_module = nn.parallel.DistributedDataParallel(module, device_ids=device_ids)
+        forward_module = ddp_module
+        if model.compile_params is not None:
+            forward_module = torch.compile(ddp_module, **model.compile_params)
+    
+    params["forward_module"] = forward_module
+    
+    def call_callback(name, params):
+        if callbacks is not None:
+            for callback in callbacks:
+                if hasattr(callback, name):
+                    f = getattr(callback, name, None)
+                    if f is not None:
+                        f(params)
+    
+    def prepare_batch(batch):
+        
+        batch_len = 1
+        if get_batch_size is not None:
+            batch_len = get_batch_size(batch)
+        else:
+            batch_len = len(batch["x"])
+        
+        if batch_transform:
+            batch = batch_transform(batch, device)
+        
+        return batch_len, batch
+    
+    def sync_context(sync):
+        
+        """
+        Gradients are reduced between processes only on sync backward
+        """
+        
+        if ddp_module is None or sync:
+            return contextlib.nullcontext()
+        
+        return ddp_module.no_sync()
+    
+    def iterate(loader):
+        if prefetch:
+            return DevicePrefetcher(loader, device, prepare_batch)
+        return map(prepare_batch, loader)
+    
+    def clear_iter():
+        if "x_batch" in params["iter"]:
+            del params["iter"]["x_batch"]
+        
+        if "y_batch" in params["iter"]:
+            del params["iter"]["y_batch"]
+        
+        if "y_pred" in params["iter"]:
+            del params["iter"]["y_pred"]
+    
+    def step_batch(batch):
+        
+        loss = None
+        
+        with get_autocast(device, precision):
+            
+            # Forward
+            if step_forward is not None:
+                loss, _ = step_forward(
+                    batch, params=params
+                )
+            
+            else:
+                
+                x_batch = batch_to(batch["x"], device)
+                y_batch = batch_to(batch["y"], device)
+                y_pred = forward_module(x_batch)
+                
+                # Calc loss
+                if step_loss is not None:
+                    loss = step_loss(y_pred, y_batch, loss_fn=loss_fn)
+                else:
+                    loss = loss_fn(y_pred, y_batch)
+                
+                params["iter"]["x_batch"] = x_batch
+                params["iter"]["y_batch"] = y_batch
+                params["iter"]["y_pred"] = y_pred
+                
+                del x_batch, y_batch, y_pred
+        
+        return loss
+    
+    def backward(loss):
+        
+        # Mean loss of accumulated batches
+        if accumulate_steps > 1 and model.loss_reduction == "mean":
+            loss = loss / accumulate_steps
+        
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+    
+    def optimizer_step():
+        
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
+        
+        accumulate["index"] = 0
+    
+    def get_chunks(batch, batch_len, size):
+        
+        if size is None or size >= batch_len:
+            return [ (batch, batch_len) ]
+        
+        # Split batch to micro batches
+        if split_batch_fn is not None:
+            chunks = split_batch_fn(batch, size)
+        else:
+            chunks = split_batch(batch, batch_len, size)
+        
+        return [
+            (chunk, min(size, batch_len - index * size))
+                for index, chunk in enumerate(chunks)
+        ]
+    
+    def forward_backward(state, batch_len, sync=True):
+        
+        # Chunks are removed after backward, so after out of memory error
+        # batch is continued from the failed chunk
+        chunks = state["chunks"]
+        while len(chunks) > 0:
+            
+            chunk, chunk_len = chunks[0]
+            with sync_context(sync and len(chunks) == 1):
+                
+                loss = step_batch(chunk)
+                
+                # Mean loss of batch is weighted mean loss of chunks
+                if model.loss_reduction == "mean" and chunk_len < batch_len:
+                    loss = loss * (chunk_len / batch_len)
+                
+                backward(loss)
+            
+            chunks.pop(0)
+            
+            if chunk_len == batch_len:
+                state["loss"] = loss
+                return loss
+            
+            state["loss"] = state["loss"] + loss.detach()
+            
+            items = state["items"]
+            for key in ["x_batch", "y_batch", "y_pred"]:
+                if key in params["iter"]:
+                    if not (key in items):
+                        items[key] = []
+                    items[key].append( batch_detach(params["iter"][key]) )
+            
+            clear_iter()
+            del loss
+        
+        for key in state["items"]:
+            params["iter"][key] = batch_cat(state["items"][key])
+        
+        return state["loss"]
+    
+    def accumulate_step(batch, batch_len):
+        
+        # New batch. Batch after out of memory error keeps its state,
+        # so gradients of done chunks are not dropped or counted twice
+        if accumulate["state"] is None:
+            
+            # Set parameter gradients to zero
+            if accumulate["index"] == 0:
+                optimizer.zero_grad()
+            
+            accumulate["state"] = {
+                "chunks": get_chunks(batch, batch_len, accumulate["size"]),
+                "loss": 0,
+                "items": {},
+            }
+        
+        sync = accumulate["index"] + 1 >= accumulate_steps
+        loss = forward_backward(accumulate["state"], batch_len, sync)
+        
+        if sync:
+            optimizer_step()
+        else:
+            accumulate["index"] += 1
+        
+        accumulate["state"] = None
+        return loss
     
-    device = model.device
-    loss_fn = model.loss
-    min_lr = model.min_lr
-    module = model.module
-    optimizer = model.optimizer
-    scheduler = model.scheduler
+    def train_step(batch, batch_len):
+        
+        while True:
+            
+            try:
+                return accumulate_step(batch, batch_len)
+            
+            except Exception as e:
+                state = accumulate["state"]
+                if micro_batch_size != "auto" or not is_oom_error(e) or \
+                    state is None or len(state["chunks"]) == 0 or \
+                    state["chunks"][0][1] <= 1:
+                    raise
+            
+            # Retry failed chunk with smaller micro batch
+            clear_iter()
+            memory_policy.clear_cache()
+            
+            chunk, chunk_len = state["chunks"].pop(0)
+            size = max(1, chunk_len // 2)
+            if accumulate["size"] is not None:
+                size = min(size, accumulate["size"])
+            
+            accumulate["size"] = size
+            state["chunks"][0:0] = get_chunks(chunk, chunk_len, size)
     
-    batch_transform = getattr(module, "batch_transform", None)
-    step_forward = getattr(module, "step_forward", None)
-    step_loss = getattr(module, "step_loss", None)
-    step_scheduler = getattr(module, "step_scheduler", None)
-    get_batch_size = getattr(module, "get_batch_size", None)
+    def flush_accumulate():
+        
+        if accumulate["index"] == 0:
+            return
+        
+        # Last backward was without sync
+        if ddp_module is not None:
+            all_reduce_grads(module.parameters())
+        
+        # Gradients are mean of accumulated batches
+        if model.loss_reduction == "mean":
+            k = accumulate_steps / accumulate["index"]
+            for param_group in optimizer.param_groups:
+                for p in param_group["params"]:
+                    if p.grad is not None:
+                        p.grad.mul_(k)
+        
+        optimizer_step()
     
-    if isinstance(loss_fn, nn.Module):
-        loss_fn = loss_fn.to(model.device)
     
-    def call_callback(name, params):
-        if callbacks is not None:
-            for callback in callbacks:
-                if hasattr(callback, name):
-                    f = getattr(callback, name, None)
-                    if f is not None:
-                        f(params)
+    def all_reduce_epoch():
+        
+        """
+        Sum metrics and counters of all processes
+        """
+        
+        status = params["status"]
+        keys = ["train_count", "val_count", "train_batch_iter", "val_batch_iter", "pos"]
+        values = all_reduce_values([ status[key] for key in keys ])
+        for key, value in zip(keys, values):
+            status[key] = int(value)
+        
+        metrics.all_reduce()
     
     
     call_callback("on_start", params)
     
-    print ("Start train " + str(model_name) + " on " + str(device))
+    if is_main_process():
+        print ("Start train " + str(model_name) + " on " + str(device))
     try:
         while model.do_training(epochs):
             
             time_start = time.time()
             
             params["status"] = model.get_epoch_train_status()
+            params["iter"]["sync"] = False
+            metrics.reset()
             
-            params["status"]["total_count"] = len(train_dataset)
+            params["status"]["total_count"] = get_rank_count(train_dataset, world_size)
             if val_dataset is not None:
-                params["status"]["total_count"] += len(val_dataset)
+                params["status"]["total_count"] += get_rank_count(val_dataset, world_size)
             
             call_callback("on_start_epoch", params)
             
             train_loader = params["train_loader"]
-            val_loader = params["val_loader"]
+            val_loader = params.get("val_loader")
+            
+            # New order of distributed sampler and iterable dataset
+            for loader in (train_loader, val_loader):
+                set_loader_epoch(loader, model.epoch)
             
             if do_train != False:
                 
                 # Train mode
                 model.train()
                 
-                for batch in train_loader:
-                    
-                    batch_len = 1
-                    if get_batch_size is not None:
-                        batch_len = get_batch_size(batch)
-                    else:
-                        batch_len = len(batch["x"])
-                    
-                    if batch_transform:
-                        batch = batch_transform(batch, device)
-                    
-                    # Set parameter gradients to zero
-                    optimizer.zero_grad()
-                    
-                    loss = None
+                for batch_len, batch in iterate(train_loader):
                     
-                    # Forward train
-                    if step_forward is not None:
-                        loss, _ = step_forward(
-                            batch, params=params
-                        )
-                    
-                    else:
-                        
-                        x_batch = batch_to(batch["x"], device)
-                        y_batch = batch_to(batch["y"], device)
-                        y_pred = module(x_batch)
-                        
-                        # Calc loss
-                        if step_loss is not None:
-                            loss = step_loss(y_pred, y_batch, loss_fn=loss_fn)
-                        else:
-                            loss = loss_fn(y_pred, y_batch)
-                        
-                        params["iter"]["x_batch"] = x_batch
-                        params["iter"]["y_batch"] = y_batch
-                        params["iter"]["y_pred"] = y_pred
-                        
-                        del x_batch, y_batch, y_pred
-                    
-                    # Backward
-                    loss.backward()
-                    optimizer.step()
+                    loss = memory_policy.run(train_step, batch, batch_len, on_oom=clear_iter)
                     
                     # Add status
+                    metrics.add("train_loss", loss)
                     params["status"]["pos"] += batch_len
                     params["status"]["train_count"] += batch_len
-                    params["status"]["train_loss_items"].append( loss.item() )
+                    params["status"]["train_batch_iter"] += 1
                     params["status"]["t"] = round(time.time() - time_start)
+                    params["iter"]["sync"] = \
+                        params["status"]["train_batch_iter"] % sync_steps == 0
                     
                     call_callback("on_train_iter", params)
                     
                     # Clear cache
-                    if "x_batch" in params["iter"]:
-                        del params["iter"]["x_batch"]
-                    
-                    if "y_batch" in params["iter"]:
-                        del params["iter"]["y_batch"]
-                    
-                    if "y_pred" in params["iter"]:
-                        del params["iter"]["y_pred"]
-                    
-                    del loss
-                    if torch.cuda.is_available():
-                        torch.cuda.empty_cache()
+                    clear_iter()
+                    del loss, batch
+                    memory_policy.on_iter()
+                
+                flush_accumulate()
             
+            params["iter"]["sync"] = True
             call_callback("on_train", params)
             
             if val_loader is not None and do_val != False:
@@ -1072,65 +2897,27 @@ def fit(
                 
                 with torch.no_grad():
 
-                    for batch in val_loader:
-                        
-                        batch_len = 1
-                        if get_batch_size is not None:
-                            batch_len = get_batch_size(batch)
-                        else:
-                            batch_len = len(batch["x"])
+                    for batch_len, batch in iterate(val_loader):
                         
-                        if batch_transform:
-                            batch = batch_transform(batch, device)
-                        
-                        loss = None
-                        
-                        # Forward
-                        if step_forward is not None:
-                            loss, _ = step_forward(
-                                batch, params=params
-                            )
-                            
-                        else:
-                            
-                            x_batch = batch_to(batch["x"], device)
-                            y_batch = batch_to(batch["y"], device)
-                            y_pred = module(x_batch)
-                            
-                            # Calc loss
-                            if step_loss is not None:
-                                loss = step_loss(y_pred, y_batch, loss_fn=loss_fn)
-                            else:
-                                loss = loss_fn(y_pred, y_batch)
-                            
-                            params["iter"]["x_batch"] = x_batch
-                            params["iter"]["y_batch"] = y_batch
-                            params["iter"]["y_pred"] = y_pred
-                            
-                            del x_batch, y_batch, y_pred
+                        loss = memory_policy.run(step_batch, batch, on_oom=clear_iter)
                         
                         # Add status
+                        metrics.add("val_loss", loss)
                         params["status"]["pos"] += batch_len
                         params["status"]["val_count"] += batch_len
-                        params["status"]["val_loss_items"].append( loss.item() )
+                        params["status"]["val_batch_iter"] += 1
                         params["status"]["t"] = round(time.time() - time_start)
+                        params["iter"]["sync"] = \
+                            params["status"]["val_batch_iter"] % sync_steps == 0
                         
                         call_callback("on_val_iter", params)
                         
                         # Clear cache
-                        if "x_batch" in params["iter"]:
-                            del params["iter"]["x_batch"]
-                        
-                        if "y_batch" in params["iter"]:
-                            del params["iter"]["y_batch"]
-                        
-                        if "y_pred" in params["iter"]:
-                            del params["iter"]["y_pred"]
-                        
-                        del loss
-                        if torch.cuda.is_available():
-                            torch.cuda.empty_cache()
+                        clear_iter()
+                        del loss, batch
+                        memory_policy.on_iter()
             
+            params["iter"]["sync"] = True
             call_callback("on_val", params)
             call_callback("on_next_epoch", params)
             
@@ -1139,6 +2926,9 @@ def fit(
             params["status"]["t"] = round(time_end - time_start)
             params["status"]["time_end"] = time_end
             
+            if distributed:
+                all_reduce_epoch()
+            
             call_callback("on_end_epoch", params)
             
             if scheduler is not None:
@@ -1152,6 +2942,8 @@ def fit(
             
             model.epoch = model.epoch + 1
             
+            memory_policy.on_epoch()
+            
         call_callback("on_end", params)
         
     except KeyboardInterrupt:
@@ -1159,58 +2951,527 @@ def fit(
         print ("")
         print ("Stopped manually")
         print ("")
+        
+        # Finish background saves
+        call_callback("on_stop", params)
 
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
 
-def save_embeddings(dataset, file_name, transform, emb_size, batch_size=8):
+def launch_worker(rank, f, world_size, backend, master_addr, master_port,
+    num_threads, args, kwargs
+):
     
-    import h5py, gc
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
     
-    loader = DataLoader(
-        dataset,
-        batch_size=batch_size,
-        drop_last=False,
-        shuffle=False
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    
+    torch.distributed.init_process_group(backend, rank=rank, world_size=world_size)
+    try:
+        f(*args, **kwargs)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def launch(f, num_processes, *args, backend=None, master_addr="127.0.0.1",
+    master_port=29500, num_threads=None, **kwargs
+):
+    
+    """
+    Run f(*args, **kwargs) in num_processes processes with initialized
+    process group. Call fit(..., distributed=True) in f to train model
+    with DistributedDataParallel. f must be module level function.
+    CPU cores are split between processes by default.
+    """
+    
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // num_processes)
+    
+    torch.multiprocessing.spawn(
+        launch_worker,
+        args=(f, num_processes, backend, master_addr, master_port,
+            num_threads, args, kwargs),
+        nprocs=num_processes,
+        join=True
     )
+
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_COMPONENTS = ["module", "optimizer", "scheduler", "scaler"]
+
+
+def state_to_cpu(obj):
     
-    pos = 0
-    next_pos = 0
-    dataset_count = len(dataset)
-    time_start = time.time()
+    """
+    Returns copy of state with tensors on CPU. The copy is not changed
+    by next train steps, so it may be saved in background thread.
+    """
+    
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    
+    if isinstance(obj, dict):
+        return obj.__class__([ (key, state_to_cpu(value)) for key, value in obj.items() ])
+    
+    if isinstance(obj, list):
+        return [ state_to_cpu(value) for value in obj ]
+    
+    if isinstance(obj, tuple):
+        return tuple( state_to_cpu(value) for value in obj )
+    
+    return copy.deepcopy(obj)
+
+
+def save_file(obj, file_path):
+    
+    """
+    Save object by torch.save with rename, so file is not read unfinished
+    """
+    
+    tmp_file = file_path + ".tmp"
+    torch.save(obj, tmp_file)
+    os.replace(tmp_file, file_path)
+
+
+def save_checkpoint(save_metrics, path):
+    
+    """
+    Save train status to checkpoint folder. Each state dict is saved
+    to own file, which may be loaded with mmap. Epoch, name and history
+    are saved to manifest.json. Folder is written as tmp folder and renamed.
+    """
+    
+    import shutil
+    
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
     
-    if os.path.exists(file_name):
-        os.remove(file_name)
+    manifest = {
+        "version": CHECKPOINT_VERSION,
+        "files": {},
+        "values": {},
+        "history": [],
+    }
     
-    with h5py.File(file_name, 'w') as file:
+    for key, value in save_metrics.items():
         
-        file_dataset = file.create_dataset(
-            'data', (dataset_count, emb_size), dtype='float32'
-        )
+        if key == "history":
+            manifest["history"] = [ [epoch, status] for epoch, status in value.items() ]
+        
+        elif key in CHECKPOINT_COMPONENTS:
+            file_name = key + ".pt"
+            torch.save(value, os.path.join(tmp_path, file_name))
+            manifest["files"][key] = file_name
+        
+        else:
+            manifest["values"][key] = value
+    
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as file:
+        json.dump(manifest, file)
+    
+    # Replace old checkpoint
+    old_path = path + ".old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def get_checkpoint_path(path):
+    
+    """
+    Returns checkpoint folder. If save was stopped between renames,
+    only old folder exists and it is used.
+    """
+    
+    old_path = path + ".old"
+    if not os.path.exists(path) and os.path.isdir(old_path):
+        return old_path
+    
+    return path
+
+
+def is_checkpoint(path):
+    path = get_checkpoint_path(path)
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "manifest.json"))
+
+
+def load_checkpoint(path, components=None, mmap=True):
+    
+    """
+    Load train status from checkpoint folder. If components is set,
+    only these state dicts are loaded. If mmap is True, tensors are mapped
+    from file and are read from disk on access.
+    """
+    
+    path = get_checkpoint_path(path)
+    manifest = load_json(os.path.join(path, "manifest.json"))
+    if manifest is None:
+        raise ValueError("Wrong checkpoint " + path)
+    
+    res = manifest["values"].copy()
+    res["history"] = { epoch: status for epoch, status in manifest["history"] }
+    
+    for key, file_name in manifest["files"].items():
+        if components is None or key in components:
+            res[key] = torch.load(os.path.join(path, file_name), mmap=mmap)
+    
+    return res
+
+
+class CheckpointWriter:
+    
+    """
+    Run save jobs in background thread. Only one job is run at time,
+    put waits for previous job. Error of job is raised by next put or wait.
+    """
+    
+    def __init__(self):
+        self.thread = None
+        self.error = None
+    
+    def __getstate__(self):
+        return {"thread": None, "error": None}
+    
+    def run(self, f, args):
+        try:
+            f(*args)
+        except Exception as e:
+            self.error = e
+    
+    def wait(self):
+        
+        """
+        Wait for current job
+        """
+        
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+    
+    def put(self, f, *args):
+        self.wait()
+        self.thread = threading.Thread(target=self.run, args=(f, args))
+        self.thread.start()
+
+
+def get_ranges(indices):
+    
+    """
+    Returns list of [start, end] of contiguous sorted indices
+    """
+    
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return []
+    
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(indices)]))
+    
+    return [ [int(indices[a]), int(indices[b - 1]) + 1] for a, b in zip(starts, ends) ]
+
+
+def merge_ranges(ranges):
+    
+    """
+    Merge overlapped and adjacent ranges
+    """
+    
+    res = []
+    for start, end in sorted(ranges):
+        if len(res) > 0 and start <= res[-1][1]:
+            res[-1][1] = max(res[-1][1], end)
+        else:
+            res.append([start, end])
+    
+    return res
+
+
+class EmbeddingsWriter:
+    
+    """
+    Writer of embeddings to HDF5 or npy file in background thread.
+    Completed ranges are saved to checkpoint file after data is flushed.
+    """
+    
+    def __init__(self, file_name, shape, dtype="float32", format=None,
+        chunk_size=None, compression=None, checkpoint_steps=16, queue_size=4
+    ):
+        self.file_name = file_name
+        self.checkpoint_file = file_name + ".done.json"
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.format = format
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.checkpoint_steps = checkpoint_steps
+        self.ranges = []
+        self.file = None
+        self.data = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.error = None
+        
+        if self.format is None:
+            self.format = "npy" if file_name.endswith(".npy") else "h5"
+    
+    def load_checkpoint(self):
+        
+        """
+        Load completed ranges. Returns False, if file must be created again.
+        """
+        
+        if not os.path.exists(self.file_name) or not os.path.exists(self.checkpoint_file):
+            return False
+        
+        checkpoint = load_json(self.checkpoint_file)
+        if checkpoint is None or checkpoint.get("shape") != list(self.shape) or \
+            checkpoint.get("dtype") != self.dtype.str:
+            return False
+        
+        self.ranges = merge_ranges(checkpoint["ranges"])
+        return True
+    
+    def save_checkpoint(self):
+        
+        """
+        Flush file and save completed ranges
+        """
+        
+        if self.format == "npy":
+            self.data.flush()
+        else:
+            self.file.flush()
+        
+        tmp_file = self.checkpoint_file + ".tmp"
+        save_json(tmp_file, {
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "ranges": self.ranges,
+        })
+        os.replace(tmp_file, self.checkpoint_file)
+    
+    def open(self, resume=True):
         
-        for batch in loader:
+        """
+        Open file. If resume, completed ranges are loaded from checkpoint.
+        """
+        
+        if not (resume and self.load_checkpoint()):
+            
+            self.ranges = []
+            for file_name in (self.file_name, self.checkpoint_file):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
             
-            batch = transform(batch)
-            file_dataset[pos:pos+len(batch["x"])] = batch["x"].cpu().numpy()
+            self.create()
+        
+        elif self.format == "npy":
+            self.data = np.lib.format.open_memmap(self.file_name, mode="r+")
+        
+        else:
+            import h5py
+            self.file = h5py.File(self.file_name, "r+")
+            self.data = self.file["data"]
+        
+        return self
+    
+    def create(self):
+        
+        if self.format == "npy":
+            self.data = np.lib.format.open_memmap(self.file_name, mode="w+",
+                dtype=self.dtype, shape=self.shape)
+            return
+        
+        import h5py
+        
+        chunks = None
+        compression = self.compression
+        if 0 in self.shape:
+            # Empty dataset can not be chunked
+            compression = None
+        elif self.chunk_size is not None:
+            chunks = (min(self.chunk_size, self.shape[0]),) + self.shape[1:]
+        elif compression is not None:
+            chunks = True
+        
+        self.file = h5py.File(self.file_name, "w")
+        self.data = self.file.create_dataset("data", self.shape, dtype=self.dtype,
+            chunks=chunks, compression=compression)
+    
+    def get_remaining(self):
+        
+        """
+        Returns indices which are not completed
+        """
+        
+        mask = np.ones(self.shape[0], dtype=bool)
+        for start, end in self.ranges:
+            mask[start:end] = False
+        
+        return np.nonzero(mask)[0]
+    
+    def write(self, indices, value):
+        for start, end in get_ranges(indices):
+            pos = int(np.searchsorted(indices, start))
+            self.data[start:end] = value[pos:pos + end - start]
+        self.ranges = merge_ranges(self.ranges + get_ranges(indices))
+    
+    def worker(self):
+        
+        step = 0
+        while True:
             
-            # Show progress
-            pos = pos + len(batch["x"])
-            if pos > next_pos:
-                next_pos = pos + 16
-                t = str(round(time.time() - time_start))
-                print ("\r" + str(math.floor(pos / dataset_count * 100)) + "% " + t + "s", end='')
+            item = self.queue.get()
+            if item is None:
+                break
             
-            del batch
+            if self.error is not None:
+                continue
             
-            # Clear cache
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            try:
+                self.write(*item)
+                step += 1
+                if step % self.checkpoint_steps == 0:
+                    self.save_checkpoint()
             
-            gc.collect()
-            file.flush()
+            except Exception as e:
+                self.error = e
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+        return self
+    
+    def put(self, indices, value):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((indices, value))
+    
+    def close(self):
+        
+        """
+        Wait writes, save checkpoint and close file
+        """
+        
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        
+        if self.data is not None and self.error is None:
+            self.save_checkpoint()
+        
+        if self.file is not None:
+            self.file.close()
+        
+        self.file = None
+        self.data = None
         
-        file.close()
+        if self.error is not None:
+            raise self.error
+
+
+def save_embeddings(dataset, file_name, transform, emb_size, batch_size=8,
+    memory_policy=None, loader_params=None, module=None, no_grad=True,
+    dtype="float32", format=None, chunk_size=None, compression=None,
+    resume=True, checkpoint_steps=16, queue_size=4
+):
+    
+    """
+    Save embeddings of dataset to HDF5 or npy file. Transform gets batch
+    and returns batch with "x" or tensor. Batches are written in background
+    thread and completed ranges are saved to file_name + ".done.json",
+    so if resume, next run continues from the last checkpoint.
+    
+    If module is set, it is switched to eval mode.
+    dtype may be "float16". chunk_size and compression are used for HDF5.
+    """
+    
+    memory_policy = get_memory_policy(memory_policy)
+    
+    if loader_params is None:
+        loader_params = {}
+    
+    dataset_count = len(dataset)
+    if isinstance(emb_size, int):
+        emb_size = (emb_size,)
+    
+    writer = EmbeddingsWriter(file_name, (dataset_count,) + tuple(emb_size),
+        dtype=dtype, format=format, chunk_size=chunk_size, compression=compression,
+        checkpoint_steps=checkpoint_steps, queue_size=queue_size)
+    writer.open(resume)
+    
+    indices = writer.get_remaining()
+    if len(indices) == 0:
+        writer.close()
+        return
+    
+    loader = create_loader(
+        torch.utils.data.Subset(dataset, indices.tolist()),
+        batch_size=batch_size,
+        **loader_params
+    )
+    
+    pos = 0
+    next_pos = 0
+    count = len(indices)
+    time_start = time.time()
+    
+    training = None
+    if module is not None:
+        training = module.training
+        module.eval()
+    
+    grad_context = torch.no_grad() if no_grad else contextlib.nullcontext()
+    
+    writer.start()
+    try:
+        with grad_context:
+            for batch in loader:
+                
+                batch = memory_policy.run(transform, batch)
+                if isinstance(batch, dict):
+                    batch = batch["x"]
+                
+                value = batch.detach().cpu().numpy().astype(writer.dtype, copy=False)
+                writer.put(indices[pos:pos + len(value)], value)
+                
+                # Show progress
+                pos = pos + len(value)
+                if pos > next_pos:
+                    next_pos = pos + 16
+                    t = str(round(time.time() - time_start))
+                    print ("\r" + str(math.floor(pos / count * 100)) + "% " + t + "s", end='')
+                
+                del batch, value
+                
+                memory_policy.on_iter()
+        
+        memory_policy.on_epoch()
+    
+    finally:
+        writer.close()
+        if training is not None:
+            module.train(training)
 
 
 def colab_upload_file_to_google_drive(src, dest):